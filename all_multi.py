@@ -0,0 +1,115 @@
+from figures import RASTER_CELLS
+
+# Prefixes of the per-sample columns of each algorithm's p-values, and the statistic shown in the heatmap.
+# In the consolidated results every (sample, algorithm) pair is a column named <statistic><sample>.<algorithm>, e.g. pVal.MCF7.ztest.
+SAMPLE_STATS = ["pVal.", "(+/-)-log10(pVal)."]
+HEATMAP_STAT = "(+/-)-log10(pVal)."
+
+def userInput(ks_db, graphics, df, min_sub, permutations=0):
+
+    import profiling
+    import engine
+
+    # User data is parsed once into unique phosphosites and a (sites x samples) matrix, shared by all algorithms.
+    # Phosphosites separated by a semicolon are split and duplicate phosphosites are averaged for every sample at once.
+    samples, sites, matrix = engine.parseSamples(df)
+
+    profiling.mark("parse")
+
+    # Each phosphosite is looked up in the site-keyed index of the K-S db once, for all algorithms.
+    matched = engine.matchSites(sites, ks_db)
+
+    profiling.mark("match")
+
+    errors = []
+    kinase_df, ks_df = scoreSites(ks_db, samples, matrix, matched, permutations, sites, errors)
+
+    profiling.mark("statistics")
+
+    # Heatmap only generated if the user chose to produce graphics during file upload.
+    # Otherwise it can be rendered later from the kinase scores with plotScores.
+    if graphics == "no":
+        svg_fig = "Heatmap was not generated for this analysis."
+        if errors:
+            svg_fig += " Kinases could not be scored with " + "; ".join(errors) + "."
+    elif graphics == "yes":
+        svg_fig = plotScores(kinase_df, min_sub)
+
+    profiling.mark("plot")
+
+    # Convert results DFs into JSON strings.
+    kinase_df = kinase_df.to_json(orient='split')
+    ks_df = ks_df.to_json(orient='split')
+
+    profiling.mark("serialize")
+
+    return kinase_df, ks_df, svg_fig
+
+# Z-test, KS and, for intensity data, KARP results of parsed samples in one consolidated kinase table, from a single match in the K-S db.
+# Z-test and KS share the matched phosphosites, the substrate counts and the mean log2(FC) of each kinase.
+# KARP sums intensities, so it is only run when every value of the dataset is positive (intensity input).
+# It leaves out ambiguous "NO_MOD" phosphosites: their values do not affect those of other phosphosites,
+# so they are dropped from the shared matrix, and the phosphosites are only matched again if any were present.
+# For each sample the table holds the mean log2(FC), z-score and KS statistic, then p-values and signed -log10(p-values) of both tests
+# (as <statistic><sample>.ztest and .ks), then KARP's sum of intensities and k-score.
+# KS or KARP failing on the dataset (e.g. KS when a kinase is linked to every matched phosphosite) does not fail the other algorithms:
+# their columns are left missing and their error is added to errors, if given.
+def scoreSites(ks_db, samples, matrix, matched, permutations=0, sites=None, errors=None):
+
+    import numpy as np
+    import pandas as pd
+    import engine
+    import ztest_multi
+    import ks_multi
+    import karp_multi
+
+    zscore_df, ks_df = ztest_multi.scoreSites(ks_db, samples, matrix, matched, permutations)
+    kolsmir_df = guardedScores(ks_multi, ks_db, samples, matrix, matched, permutations, errors)
+    kolsmir_df = kolsmir_df.set_index("Kinase").reindex(zscore_df["Kinase"]).reset_index()
+    kscore_df = None
+    if sites is not None and matrix.size > 0 and (matrix > 0).all():
+        keep = [n for n, site in enumerate(sites) if "NO_MOD" not in site]
+        if len(keep) == len(sites):
+            kscore_df = guardedScores(karp_multi, ks_db, samples, matrix, matched, permutations, errors)
+        else:
+            karp_sites = [sites[n] for n in keep]
+            kscore_df = guardedScores(karp_multi, ks_db, samples, matrix[keep], engine.matchSites(karp_sites, ks_db), permutations, errors)
+        kscore_df = kscore_df.set_index("Kinase").reindex(zscore_df["Kinase"]).reset_index()
+
+    columns = {"Kinase": zscore_df["Kinase"], "Sub.Count": zscore_df["Sub.Count"]}
+    if kscore_df is not None:
+        columns["Total.Sub.Count"] = kscore_df["Total.Sub.Count"].values
+    for curr_col in samples:
+        z_scores = zscore_df["zSc." + curr_col].values
+        z_pvals = zscore_df["pVal." + curr_col].values
+        columns["mnlog2(FC)." + curr_col] = zscore_df["mnlog2(FC)." + curr_col].values
+        columns["zSc." + curr_col] = z_scores
+        columns["(+/-)KS." + curr_col] = kolsmir_df["(+/-)KS." + curr_col].values
+        # -log10 of the z-test p-value is signed by the z-score, as the KS one is signed by the mean log2(FC).
+        columns["pVal." + curr_col + ".ztest"] = z_pvals
+        with np.errstate(divide='ignore'):
+            columns["(+/-)-log10(pVal)." + curr_col + ".ztest"] = np.where(z_scores < 0, -1, 1) * np.log10(1/z_pvals)
+        columns["pVal." + curr_col + ".ks"] = kolsmir_df["pVal." + curr_col].values
+        columns["(+/-)-log10(pVal)." + curr_col + ".ks"] = kolsmir_df["(+/-)-log10(pVal)." + curr_col].values
+        if kscore_df is not None:
+            for stat in karp_multi.SAMPLE_STATS:
+                columns[stat + curr_col] = kscore_df[stat + curr_col].values
+    kinase_df = pd.DataFrame(columns)
+
+    return kinase_df, ks_df
+
+# Kinase scores of one algorithm. If it raises, the kinases are scored as if no phosphosite matched (an empty table with its columns),
+# and its error is recorded in errors.
+def guardedScores(mod, ks_db, samples, matrix, matched, permutations, errors=None):
+    import engine
+    try:
+        return mod.scoreSites(ks_db, samples, matrix, matched, permutations)[0]
+    except (ValueError, TypeError) as e:
+        if errors is not None:
+            errors.append(mod.__name__.split("_")[0] + ": " + str(e))
+        return mod.scoreSites(ks_db, samples, matrix, engine.matchSites([], ks_db), permutations)[0]
+
+# The heatmap of signed -log10(p-values) of the z-test and KS test across samples is drawn like that of the KS algorithm.
+def plotScores(kinase_df, min_sub, size=1.0, fmt="svg", raster_cells=RASTER_CELLS):
+    import ks_multi
+    return ks_multi.plotScores(kinase_df, min_sub, size, fmt, raster_cells)
@@ -2,6 +2,33 @@ from datetime import timedelta
 import os
 
 PERMANENT_SESSION_LIFETIME = timedelta(minutes=5)
+# Uploaded datasets waiting in Redis for an analysis task expire after this time.
+DATASET_LIFETIME = timedelta(hours=1)
+# Result cache: maximum number of cached results and how long each one is kept.
+RESULT_CACHE_SIZE = 200
+RESULT_CACHE_TTL = timedelta(hours=24)
+# Result artifact store: finished results are kept outside the session for this long, up to ARTIFACT_MAX_SIZE bytes per result.
+ARTIFACT_LIFETIME = timedelta(hours=1)
+ARTIFACT_MAX_SIZE = 64 * 1024 * 1024
+ARTIFACT_COMPRESSION = True
+# Threads used by each analysis to process the samples of multi-sample datasets in parallel.
+# With several Celery worker processes per machine, divide the cores between them.
+COLUMN_WORKERS = os.cpu_count() or 1
+# How the peak memory of each analysis stage is measured, in addition to its wall time (see profiling.py):
+# "rss" (no overhead), "tracemalloc" (exact per stage, but slows analyses down several times) or None.
+PROFILE_MEMORY = "rss"
+# Largest number of permutations accepted for empirical p-values (Z-test and KS algorithms).
+MAX_PERMUTATIONS = 100000
+# Batch API: largest accepted request body in bytes, most jobs (datasets x analyses) per batch,
+# and how long batch records and their results are kept.
+BATCH_MAX_SIZE = 100 * 1024 * 1024
+BATCH_MAX_JOBS = 1000
+BATCH_LIFETIME = timedelta(hours=24)
+# Seconds a results or plot request waits for its task to finish. Must stay below the gunicorn and router request timeouts (30s),
+# with time left to store the results once the task has finished.
+RESULT_WAIT_TIMEOUT = 20
+# Token required by the operational endpoints (/admin/stage-stats, /cache-stats and /metrics). They are disabled while it is not set.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
 SECRET_KEY = 'your-secret-key'
 DEBUG = False
 REDIS_URL = 'redis://localhost:6379'
@@ -0,0 +1,61 @@
+import zlib
+
+# Redis key prefix of the result artifact store.
+# The artifacts of one analysis (scores, links and plot) are kept together in a hash under ARTIFACT_PREFIX + task id,
+# so a single TTL covers all of them. The user session only holds the task id.
+ARTIFACT_PREFIX = "artifact:"
+ARTIFACT_NAMES = ["scores", "links", "plot"]
+
+# Each stored value starts with a one-byte marker telling whether the rest is zlib-compressed (z) or raw UTF-8 (r).
+RAW = b"r"
+COMPRESSED = b"z"
+
+# A value is encoded for storage, optionally zlib-compressed at a fast compression level (JSON tables and SVG compress well).
+def encodeArtifact(data, compress):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return COMPRESSED + zlib.compress(data, 1) if compress else RAW + data
+
+# The artifacts of a finished task are stored with a TTL (seconds or a timedelta).
+# Further tables listed under "tables" in the result's metadata (its fourth element) are stored with them, under their names.
+# Results larger than max_size bytes in total (after compression) are not stored and a ValueError is raised.
+def putArtifacts(client, taskid, result, ttl, max_size, compress=True):
+    values = {}
+    for name, artifact in zip(ARTIFACT_NAMES, result):
+        values[name] = encodeArtifact(artifact, compress)
+    if len(result) > 3:
+        for name, artifact in result[3].get("tables", {}).items():
+            values[name] = encodeArtifact(artifact, compress)
+    size = sum(len(value) for value in values.values())
+    if size > max_size:
+        raise ValueError("Result of " + str(size) + " bytes exceeds the artifact size limit of " + str(max_size) + " bytes.")
+    pipe = client.pipeline()
+    pipe.delete(ARTIFACT_PREFIX + taskid)
+    pipe.hset(ARTIFACT_PREFIX + taskid, mapping=values)
+    pipe.expire(ARTIFACT_PREFIX + taskid, ttl)
+    pipe.execute()
+
+    return size
+
+# A further artifact (e.g. a rendered plot) is added to the stored results of a task. It expires together with them.
+# Nothing is stored if the results have already expired.
+def putArtifact(client, taskid, name, data, max_size, compress=True):
+    value = encodeArtifact(data, compress)
+    if len(value) > max_size:
+        raise ValueError("Artifact of " + str(len(value)) + " bytes exceeds the artifact size limit of " + str(max_size) + " bytes.")
+    if client.exists(ARTIFACT_PREFIX + taskid):
+        client.hset(ARTIFACT_PREFIX + taskid, name, value)
+
+# One artifact of a task is read back as a string (or bytes with binary=True), or None if it has expired.
+def getArtifact(client, taskid, name, binary=False):
+    if taskid is None:
+        return None
+    value = client.hget(ARTIFACT_PREFIX + taskid, name)
+    if value is None:
+        return None
+    data = zlib.decompress(value[1:]) if value[:1] == COMPRESSED else value[1:]
+    return data if binary else data.decode("utf-8")
+
+# Rendered plots are stored as artifacts named after their plot parameters, so each parameter set is rendered only once.
+def plotName(min_sub, size, fmt):
+    return "plot:" + str(min_sub) + ":" + str(size) + ":" + fmt
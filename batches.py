@@ -0,0 +1,79 @@
+import json
+
+# Redis key prefix of batch records. A batch record is a hash holding the batch's job list ("jobs", as JSON)
+# and a "stored:<task id>" field for each job whose results have been moved to the artifact store,
+# or an "error:<task id>" field holding the error if its results could not be stored.
+BATCH_PREFIX = "batch:"
+
+# A batch request is checked and expanded into its jobs: every dataset is analysed with every (algorithm, database, permutations) combination.
+# The request is a JSON object such as
+#   {"datasets": [{"name": "cells", "data": "<contents of a .tsv file>"}, ...],
+#    "analyses": [{"algorithm": "ks_multi", "database": "psp", "permutations": 0}, ...]}
+# permutations (optional, up to max_permutations) requests empirical p-values for the Z-test and KS algorithms.
+# The database "all" compares all databases in one job (see multidb.userInput).
+# Batches return no plots, so plot parameters such as min_sub are not needed. Earlier requests that include them are accepted.
+# Returns the dataset contents by name and the list of jobs. A ValueError describes the first invalid entry.
+def batchJobs(spec, algorithms, databases, max_jobs, max_permutations):
+    if not isinstance(spec, dict) or not isinstance(spec.get("datasets"), list) or not isinstance(spec.get("analyses"), list):
+        raise ValueError("A batch needs a list of datasets and a list of analyses.")
+    datasets = {}
+    for n, dataset in enumerate(spec["datasets"]):
+        if not isinstance(dataset, dict) or not isinstance(dataset.get("data"), str):
+            raise ValueError("Dataset " + str(n + 1) + " has no data.")
+        name = str(dataset.get("name", n + 1))
+        if name in datasets:
+            raise ValueError("Dataset name " + name + " is used more than once.")
+        datasets[name] = dataset["data"].encode("utf-8")
+    analyses = []
+    for n, analysis in enumerate(spec["analyses"]):
+        if not isinstance(analysis, dict):
+            raise ValueError("Analysis " + str(n + 1) + " is not an object.")
+        algorithm = analysis.get("algorithm")
+        database = analysis.get("database")
+        permutations = analysis.get("permutations", 0)
+        if algorithm not in algorithms or database not in databases:
+            raise ValueError("Analysis " + str(n + 1) + " needs a valid algorithm and database.")
+        if not isinstance(permutations, int) or isinstance(permutations, bool) or not 0 <= permutations <= max_permutations:
+            raise ValueError("Analysis " + str(n + 1) + " needs between 0 and " + str(max_permutations) + " permutations.")
+        analyses.append({"algorithm": algorithm, "database": database, "permutations": permutations})
+    if len(datasets) * len(analyses) > max_jobs:
+        raise ValueError("A batch may contain at most " + str(max_jobs) + " jobs.")
+    jobs = [dict(analysis, dataset=name) for name in datasets for analysis in analyses]
+
+    return datasets, jobs
+
+# Identical jobs of a batch (same dataset contents, database version, algorithm and permutations, i.e. the same result cache key)
+# are merged into one job, which lists the names of all datasets it stands for.
+def mergeJobs(jobs, keys):
+    merged = {}
+    for job, key in zip(jobs, keys):
+        if key in merged:
+            if job["dataset"] not in merged[key]["datasets"]:
+                merged[key]["datasets"].append(job["dataset"])
+        else:
+            merged[key] = {"datasets": [job["dataset"]], "algorithm": job["algorithm"], "database": job["database"], "permutations": job["permutations"]}
+
+    return merged
+
+def putBatch(client, batch_id, jobs, ttl):
+    pipe = client.pipeline()
+    pipe.hset(BATCH_PREFIX + batch_id, "jobs", json.dumps(jobs))
+    pipe.expire(BATCH_PREFIX + batch_id, ttl)
+    pipe.execute()
+
+# The job list of a batch, the task ids of the jobs whose results have been stored and the errors of the jobs whose results could not be
+# stored (by task id), or (None, None, None) if the batch has expired.
+def getBatch(client, batch_id):
+    fields = client.hgetall(BATCH_PREFIX + batch_id)
+    if b"jobs" not in fields:
+        return None, None, None
+    stored = set(field.decode("utf-8")[len("stored:"):] for field in fields if field.startswith(b"stored:"))
+    errors = dict((field.decode("utf-8")[len("error:"):], value.decode("utf-8")) for field, value in fields.items() if field.startswith(b"error:"))
+    return json.loads(fields[b"jobs"]), stored, errors
+
+# A job is marked as stored once its results are in the artifact store, or with the error that prevented storing them.
+def markStored(client, batch_id, taskid, error=None):
+    if error is None:
+        client.hset(BATCH_PREFIX + batch_id, "stored:" + taskid, 1)
+    else:
+        client.hset(BATCH_PREFIX + batch_id, "error:" + taskid, error)
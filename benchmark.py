@@ -0,0 +1,154 @@
+import argparse
+import importlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import scipy
+
+from databases import loadDatabase
+
+# Benchmark of all KSEA algorithms on synthetic datasets.
+# Datasets are shaped like the starter-pack files (static/starter-pack): a phosphosite column followed by one column per sample,
+# with log2(FC) values for the Z-test and KS algorithms and raw intensities for KARP and for all algorithms at once (all_multi, which then runs KARP too).
+# Every algorithm is timed against every database, for every combination of site count, sample count, database overlap and graphics choice.
+# Results are written to a JSON report, which can be compared with an earlier report to catch regressions.
+#
+# Example:
+#   python benchmark.py --sites 1000,10000,100000 --samples 1,10,100 --overlap 0.5 --output benchmark.json
+#   python benchmark.py --baseline benchmark.json --tolerance 0.2
+
+ALGORITHMS = ["ztest_single", "karp_single", "ks_single", "ztest_multi", "karp_multi", "ks_multi", "all_multi"]
+DATABASES = ["psp", "pdts", "edges"]
+
+# A synthetic dataset with n_sites phosphosite rows and n_samples value columns is generated.
+# A fraction overlap of the rows are phosphosites known to the database, the others are made-up sites that match no kinase.
+# Known sites are drawn without replacement while the database has enough of them, so larger datasets also contain duplicate sites.
+# Like the starter-pack files, every site ends with a semicolon.
+def syntheticDataset(ks_db, n_sites, n_samples, overlap, intensities=False, seed=0):
+    rng = np.random.default_rng(seed)
+    db_sites = sorted(ks_db["sites"])
+    n_known = int(round(n_sites * overlap))
+    known = rng.choice(db_sites, size=n_known, replace=n_known > len(db_sites)).tolist()
+    unknown = ["SYN" + str(n) + "(S" + str(rng.integers(1, 1000)) + ")" for n in range(n_sites - n_known)]
+    sites = np.array([site + ";" for site in known + unknown], dtype=object)
+    rng.shuffle(sites)
+
+    if intensities:
+        header = ["gene(phosphorylated amino acids);"] + ["Sample." + str(n + 1) for n in range(n_samples)]
+        values = rng.lognormal(mean=0.0, sigma=1.5, size=(n_sites, n_samples))
+    else:
+        header = ["sh.index.sites"] + ["Sample." + str(n + 1) + ".fold" for n in range(n_samples)]
+        values = rng.normal(loc=0.0, scale=1.0, size=(n_sites, n_samples))
+    df = pd.DataFrame(values, columns=header[1:])
+    df.insert(0, header[0], sites)
+
+    return df
+
+# One benchmark case is run repeat times. Wall times of every run are recorded with the size of the returned results.
+# The first run of each algorithm also imports its libraries, so the best time is the one to compare.
+# An error in any run is recorded instead, so that one failing case does not stop the benchmark.
+def runCase(alg, ks_db, df, graphics, min_sub, repeat, permutations=0):
+    mod = importlib.import_module(alg)
+    times = []
+    try:
+        for n in range(repeat):
+            start = time.perf_counter()
+            result = mod.userInput(ks_db, graphics, df, min_sub, permutations)
+            times.append(time.perf_counter() - start)
+    except Exception as e:
+        return {"error": type(e).__name__ + ": " + str(e)}
+
+    return {"times": times, "best": min(times), "median": statistics.median(times),
+            "scores_bytes": len(result[0]), "links_bytes": len(result[1]), "plot_bytes": len(result[2])}
+
+# Environment details stored with each report, so that reports from different machines or library versions are not compared by mistake.
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__))).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"date": datetime.utcnow().isoformat() + "Z", "commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "numpy": np.__version__, "pandas": pd.__version__, "scipy": scipy.__version__}
+
+# Identifies a case across reports.
+def caseKey(case):
+    return (case["algorithm"], case["database"], case["sites"], case["samples"], case["overlap"], case["graphics"], case.get("permutations", 0))
+
+# Cases of a report that became slower than in the baseline report by more than tolerance (a fraction) are listed.
+# Best times are compared, as they are least affected by other load on the machine.
+def regressions(report, baseline, tolerance):
+    previous = dict((caseKey(case), case) for case in baseline["cases"] if "best" in case)
+    slower = []
+    for case in report["cases"]:
+        old = previous.get(caseKey(case))
+        if old is None or "best" not in case:
+            continue
+        ratio = case["best"] / old["best"]
+        if ratio > 1 + tolerance:
+            slower.append({"case": caseKey(case), "baseline": old["best"], "best": case["best"], "ratio": ratio})
+
+    return slower
+
+def parseList(value, kind):
+    return [kind(x) for x in value.split(",") if x != ""]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the KSEA algorithms on synthetic datasets.")
+    parser.add_argument("--sites", default="1000,10000", help="comma-separated phosphosite counts, e.g. 1000,10000,100000,500000")
+    parser.add_argument("--samples", default="1,10", help="comma-separated sample counts for the multi-sample algorithms, e.g. 1,10,100,500")
+    parser.add_argument("--overlap", default="0.5", help="comma-separated fractions of sites known to the database")
+    parser.add_argument("--algorithms", default=",".join(ALGORITHMS))
+    parser.add_argument("--databases", default=",".join(DATABASES))
+    parser.add_argument("--graphics", default="no,yes", help="comma-separated graphics choices (no, yes)")
+    parser.add_argument("--min-sub", type=int, default=5)
+    parser.add_argument("--permutations", type=int, default=0, help="permutations for empirical p-values of the Z-test and KS algorithms")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json", help="path of the JSON report")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline, as a fraction")
+    args = parser.parse_args(argv)
+
+    algorithms = parseList(args.algorithms, str)
+    report = {"environment": environment(), "settings": vars(args), "cases": []}
+    for db_key in parseList(args.databases, str):
+        ks_db = loadDatabase(db_key)
+        for n_sites in parseList(args.sites, int):
+            for overlap in parseList(args.overlap, float):
+                # Datasets are shared by all algorithms of the same data type, so that they are timed on identical data.
+                datasets = {}
+                for alg in algorithms:
+                    intensities = alg.startswith("karp") or alg.startswith("all")
+                    # Single-sample algorithms only read the first sample column.
+                    sample_counts = [1] if alg.endswith("single") else parseList(args.samples, int)
+                    for n_samples in sample_counts:
+                        if (n_samples, intensities) not in datasets:
+                            datasets[(n_samples, intensities)] = syntheticDataset(ks_db, n_sites, n_samples, overlap, intensities, args.seed)
+                        df = datasets[(n_samples, intensities)]
+                        for graphics in parseList(args.graphics, str):
+                            case = {"algorithm": alg, "database": db_key, "sites": n_sites, "samples": n_samples, "overlap": overlap, "graphics": graphics,
+                                    "permutations": args.permutations}
+                            case.update(runCase(alg, ks_db, df, graphics, args.min_sub, args.repeat, args.permutations))
+                            report["cases"].append(case)
+                            print(json.dumps(case), flush=True)
+
+    if args.baseline:
+        with open(args.baseline, "r") as baseline:
+            report["regressions"] = regressions(report, json.load(baseline), args.tolerance)
+        for slower in report["regressions"]:
+            print("Regression: " + json.dumps(slower), file=sys.stderr)
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=1)
+
+    return 1 if report.get("regressions") else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
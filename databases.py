@@ -1,3 +1,8 @@
+import os
+import json
+import hashlib
+import numpy as np
+
 # A parsed version of the PSP database is uploaded.
 def uploadPSP():
     ks_data=[]
@@ -54,4 +59,134 @@ def uploadEDGES():
         edges_db.append([site, kin, seq, source])
     edges.close()
     
-    return edges_db
\ No newline at end of file
+    return edges_db
+
+# The total number of known phosphosites for each kinase in a parsed database is counted here.
+# KARP uses these counts to compute the K-score of every kinase.
+def countSubstrates(ks_db):
+    total_subs={}
+    for entry in ks_db:
+        kin=entry[1]
+        if kin not in total_subs:
+            total_subs[kin]=1
+        else:
+            total_subs[kin]+=1
+    
+    return total_subs
+
+# A site-keyed index is built once for a parsed database.
+# Each phosphosite maps to a list of (kinase, sequence, source) entries, kept in database order.
+# This allows each phosphosite in a dataset to be matched with a single lookup instead of a full database scan.
+# Per-kinase total substrate counts are stored alongside the index.
+def indexDatabase(ks_db):
+    site_index={}
+    for entry in ks_db:
+        site=entry[0]
+        if site not in site_index:
+            site_index[site]=[]
+        site_index[site].append((entry[1], entry[2], entry[3]))
+    
+    return {"sites": site_index, "totals": countSubstrates(ks_db)}
+
+# Source .tsv file of each database and the function parsing it.
+db_files = {"psp": "databases/psp_db.tsv", "pdts": "databases/pdts_db.tsv", "edges": "databases/edges_db.tsv"}
+db_uploads = {"psp": uploadPSP, "pdts": uploadPDTS, "edges": uploadEDGES}
+
+# Compiled databases are stored here, one sub-directory per database.
+COMPILED_DIR = "databases/compiled"
+# Incremented whenever the layout of the compiled files changes, so that older artifacts are treated as stale.
+COMPILED_VERSION = 1
+
+# Checksums of the database .tsv files read by this process, by database name.
+source_checksums = {}
+
+# SHA-1 checksum of a database .tsv file. A compiled database is only used if it was built from the same file.
+# Each file is hashed once per process; the checksum is then reused, e.g. as the database version of cached results.
+def sourceChecksum(name):
+    if name not in source_checksums:
+        digest = hashlib.sha1()
+        with open(db_files[name], "rb") as source:
+            digest.update(source.read())
+        source_checksums[name] = digest.hexdigest()
+    return source_checksums[name]
+
+# A database is compiled into a compact binary artifact made of .npy files and a small JSON header.
+# All strings (sites, kinases, sequences and sources) are stored once in a newline-separated string table.
+# Database entries are stored as an integer-coded (entries x 4) array, grouped by phosphosite in database order.
+# site_ptr holds, for each unique phosphosite, the range of its entries so that the site index needs no further parsing.
+def compileDatabase(name):
+    ks_db = db_uploads[name]()
+    strings=[]
+    codes={}
+    entries=[]
+    for entry in ks_db:
+        row=[]
+        for field in entry:
+            if field not in codes:
+                codes[field]=len(strings)
+                strings.append(field)
+            row.append(codes[field])
+        entries.append(row)
+    entries=np.array(entries, dtype=np.int32).reshape(len(entries), 4)
+
+    # Entries are grouped by phosphosite. A stable sort keeps database order within each phosphosite.
+    order=np.argsort(entries[:, 0], kind="stable")
+    entries=entries[order]
+    starts=np.flatnonzero(np.append(True, entries[1:, 0] != entries[:-1, 0]))
+    site_ptr=np.append(starts, len(entries)).astype(np.int64)
+
+    out_dir=os.path.join(COMPILED_DIR, name)
+    os.makedirs(out_dir, exist_ok=True)
+    # The header is removed first and written last, so a partially written artifact is always treated as stale.
+    header_file=os.path.join(out_dir, "header.json")
+    if os.path.exists(header_file):
+        os.remove(header_file)
+    np.save(os.path.join(out_dir, "strings.npy"), np.frombuffer("\n".join(strings).encode("utf-8"), dtype=np.uint8))
+    np.save(os.path.join(out_dir, "entries.npy"), entries)
+    np.save(os.path.join(out_dir, "site_ptr.npy"), site_ptr)
+    with open(header_file, "w") as header:
+        json.dump({"version": COMPILED_VERSION, "source": sourceChecksum(name), "entries": len(entries)}, header)
+
+# A compiled database is read and turned into the same site index and kinase totals as indexDatabase.
+# The arrays are only needed while the index is built, so they are read into memory rather than memory-mapped.
+# Each distinct string is decoded only once and shared by every entry that refers to it.
+# None is returned if the artifact is missing or stale, i.e. built by another layout version or from a different .tsv file.
+def loadCompiled(name):
+    out_dir=os.path.join(COMPILED_DIR, name)
+    try:
+        with open(os.path.join(out_dir, "header.json"), "r") as header:
+            header=json.load(header)
+    except (OSError, ValueError):
+        return None
+    if header.get("version") != COMPILED_VERSION or header.get("source") != sourceChecksum(name):
+        return None
+
+    strings=np.load(os.path.join(out_dir, "strings.npy")).tobytes().decode("utf-8").split("\n")
+    entries=np.load(os.path.join(out_dir, "entries.npy"))
+    site_ptr=np.load(os.path.join(out_dir, "site_ptr.npy"))
+
+    site_index={}
+    rows=entries.tolist()
+    bounds=site_ptr.tolist()
+    for n in range(len(bounds) - 1):
+        group=rows[bounds[n]:bounds[n + 1]]
+        site_index[strings[group[0][0]]]=[(strings[y[1]], strings[y[2]], strings[y[3]]) for y in group]
+
+    kin_codes, kin_counts=np.unique(entries[:, 1], return_counts=True)
+    total_subs=dict((strings[k], int(c)) for k, c in zip(kin_codes.tolist(), kin_counts.tolist()))
+
+    return {"sites": site_index, "totals": total_subs}
+
+# A database is loaded by name ("psp", "pdts" or "edges") as a site index with kinase totals.
+# The compiled artifact is used when it is up to date. Otherwise the .tsv file is parsed and indexed.
+def loadDatabase(name):
+    ks_db = loadCompiled(name)
+    if ks_db is None:
+        ks_db = indexDatabase(db_uploads[name]())
+    return ks_db
+
+# Running this module compiles all databases, e.g. as part of a deployment build step.
+if __name__ == '__main__':
+    for name in db_files:
+        compileDatabase(name)
+        print("Compiled " + name + " database into " + os.path.join(COMPILED_DIR, name))
@@ -0,0 +1,40 @@
+from io import BytesIO
+import numpy as np
+import pandas as pd
+
+# An uploaded dataset is packed into a compact binary blob (an uncompressed .npz archive) for the analysis task.
+# Each column is stored as its own array. Numeric columns are stored as float64.
+# Text columns (e.g. phosphosites) are stored as concatenated UTF-8 bytes with an array of end offsets.
+# Missing text cells are stored as empty strings so that the algorithms skip them as before.
+def packDataset(df):
+    arrays={"columns": np.frombuffer("\t".join(df.columns.astype(str)).encode("utf-8"), dtype=np.uint8)}
+    for n, name in enumerate(df.columns):
+        col=df.iloc[:, n]
+        if pd.api.types.is_numeric_dtype(col):
+            arrays["num_" + str(n)]=col.to_numpy(dtype=float)
+        else:
+            cells=[cell.encode("utf-8") for cell in col.fillna("").astype(str)]
+            arrays["text_" + str(n)]=np.frombuffer(b"".join(cells), dtype=np.uint8)
+            arrays["ends_" + str(n)]=np.cumsum([len(cell) for cell in cells], dtype=np.int64)
+    buffer=BytesIO()
+    np.savez(buffer, **arrays)
+
+    return buffer.getvalue()
+
+# A packed dataset is turned back into a dataframe with the original column names and order.
+def unpackDataset(blob):
+    data={}
+    with np.load(BytesIO(blob), allow_pickle=False) as arrays:
+        columns=arrays["columns"].tobytes().decode("utf-8").split("\t")
+        for n in range(len(columns)):
+            if "num_" + str(n) in arrays:
+                data[n]=arrays["num_" + str(n)]
+            else:
+                text=arrays["text_" + str(n)].tobytes()
+                ends=arrays["ends_" + str(n)].tolist()
+                starts=[0] + ends[:-1]
+                data[n]=[text[a:b].decode("utf-8") for a, b in zip(starts, ends)]
+    df=pd.DataFrame(data)
+    df.columns=columns
+
+    return df
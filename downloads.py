@@ -0,0 +1,49 @@
+import importlib.util
+import zlib
+from io import BytesIO
+
+# Download formats of results tables: file extension, mimetype and whether the file can be streamed.
+# Text formats are streamed in chunks of rows. Parquet and Feather are columnar and are written in one piece.
+# Parquet and Feather require pyarrow, which is optional.
+FORMATS = {
+    "csv": (".csv", "text/csv", True),
+    "tsv": (".tsv", "text/tab-separated-values", True),
+    "parquet": (".parquet", "application/vnd.apache.parquet", False),
+    "feather": (".feather", "application/vnd.apache.arrow.file", False),
+}
+
+# Number of table rows encoded per streamed chunk.
+CHUNK_ROWS = 5000
+
+# Parquet and Feather downloads are offered only when pyarrow is installed.
+def binaryFormats():
+    if importlib.util.find_spec("pyarrow") is None:
+        return []
+    return ["parquet", "feather"]
+
+# A results table is encoded as CSV (sep=",") or TSV (sep="\t") one chunk of rows at a time.
+# The table itself is already in memory as a dataframe; chunking only avoids also building the whole file as one string.
+def textChunks(df, sep, chunk_rows=CHUNK_ROWS):
+    yield df.iloc[:0].to_csv(sep=sep, index=False).encode("utf-8")
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows].to_csv(sep=sep, index=False, header=False).encode("utf-8")
+
+# Streamed chunks are gzip-compressed on the fly.
+def gzipChunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+# A results table is written as a Parquet or Feather file.
+def binaryTable(df, fmt):
+    buffer = BytesIO()
+    df.columns = df.columns.astype(str)
+    if fmt == "parquet":
+        df.to_parquet(buffer, index=False)
+    else:
+        df.reset_index(drop=True).to_feather(buffer)
+
+    return buffer.getvalue()
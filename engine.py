@@ -0,0 +1,297 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import scipy.stats as st
+
+# Number of threads that process the samples (columns) of a multi-sample analysis in parallel.
+# numpy releases the GIL while sorting and summing, so threads use separate cores without copying the data into other processes.
+COLUMN_WORKERS = os.cpu_count() or 1
+
+# KS p-values are exact, as with scipy's ks_2samp default, unless a kinase's substrate or non-substrate sample has more than KS_EXACT_MAX values.
+KS_EXACT_MAX = 10000
+
+# Empirical p-values: random permutations are drawn from a fixed seed, so results are reproducible (and can be cached).
+# Permutations are processed in blocks of about PERMUTATION_BLOCK bytes to bound memory use.
+PERMUTATION_SEED = 0
+PERMUTATION_BLOCK = 64 * 1024 * 1024
+
+# The uploaded dataset is parsed once into a list of unique phosphosites and a (sites x samples) matrix.
+# Multiple phosphosites separated by a semicolon are split here, each receiving the values of its row.
+# If the same phosphosite has been detected more than once, its mean value is calculated for each sample.
+# Rows containing empty cells are skipped. Ambiguous "NO_MOD" phosphosites are omitted when requested (KARP).
+def parseSamples(df, omit_no_mod=False):
+    header = df.columns.values.tolist()
+    user_file = df.values.tolist()
+    site_pos = {}
+    sites = []
+    values = []
+    split_site = []
+    split_row = []
+    for line in user_file:
+        if "" in line:
+            continue
+        row = len(values)
+        matched = False
+        for s in line[0].upper().split(";"):
+            if s == '':
+                continue
+            if omit_no_mod and "NO_MOD" in s:
+                continue
+            if s not in site_pos:
+                site_pos[s] = len(sites)
+                sites.append(s)
+            split_site.append(site_pos[s])
+            split_row.append(row)
+            matched = True
+        if matched:
+            values.append(line[1:])
+
+    samples = header[1:]
+    values = np.array(values, dtype=float).reshape(len(values), len(samples))
+    split_site = np.array(split_site, dtype=int)
+
+    # Values of split phosphosites are accumulated in file order and divided by the number of detections.
+    matrix = np.zeros((len(sites), len(samples)))
+    np.add.at(matrix, split_site, values[split_row])
+    matrix /= np.bincount(split_site, minlength=len(sites)).reshape(-1, 1)
+
+    return samples, sites, matrix
+
+# Each phosphosite is looked up in the site-keyed index of the K-S db.
+# Every kinase-substrate link is kept as a row of K-S information, with a parallel kinase incidence structure:
+# link_site holds the matrix row of each link's phosphosite and link_kin the position of its kinase in kinases.
+# Kinases are listed in order of their first link.
+def matchSites(sites, ks_db):
+    site_index = ks_db["sites"]
+    kin_pos = {}
+    kinases = []
+    links = []
+    link_site = []
+    link_kin = []
+    for n, x in enumerate(sites):
+        if x in site_index:
+            for y in site_index[x]:
+                if y[0] not in kin_pos:
+                    kin_pos[y[0]] = len(kinases)
+                    kinases.append(y[0])
+                links.append([y[0], x, y[1], y[2]])
+                link_site.append(n)
+                link_kin.append(kin_pos[y[0]])
+
+    return kinases, links, np.array(link_site, dtype=int), np.array(link_kin, dtype=int)
+
+# The number of substrates of each kinase and the sum and mean of their values are computed for all samples in one pass.
+# Sums are accumulated in link order, as in the per-kinase lists of the original loops.
+def kinaseStats(matrix, link_site, link_kin, n_kin):
+    counts = np.bincount(link_kin, minlength=n_kin)
+    sums = np.zeros((n_kin, matrix.shape[1]))
+    np.add.at(sums, link_kin, matrix[link_site])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts.reshape(-1, 1)
+
+    return counts, sums, means
+
+# Kinase z-scores are calculated against the mean and standard deviation of all phosphosites in each sample.
+# p-values assume z-scores are normally distributed and are taken from the tail the z-score falls in.
+def zScores(matrix, means, counts):
+    all_mean = matrix.sum(axis=0) / float(matrix.shape[0])
+    all_std = np.std(matrix, axis=0)
+    z = (means - all_mean) * np.sqrt(counts).reshape(-1, 1) / all_std
+    dist = st.norm.cdf(z)
+    pvals = np.where(z < 0, dist, 1.0 - dist)
+
+    return z, pvals
+
+# Kinase K-scores are calculated from the summed substrate intensities relative to all intensities in each sample.
+# totals holds the number of known sites in the database for each kinase.
+def kScores(matrix, sums, counts, totals):
+    all_sum = matrix.sum(axis=0)
+    kscores = (sums / all_sum) * np.sqrt(counts / np.array(totals, dtype=float)).reshape(-1, 1) * 10**6
+
+    return kscores
+
+# Per-sample statistics of shape (kinases x samples) are interleaved into consecutive columns for each sample.
+# e.g. mean.1, z.1, p.1, mean.2, z.2, p.2 ...
+def interleave(*stats):
+    n_kin, n_cols = stats[0].shape
+    return np.stack(stats, axis=2).reshape(n_kin, len(stats) * n_cols)
+
+# Matched phosphosites form the universe of values that kinase substrates are compared against in the KS test.
+# universe holds the matrix rows of matched phosphosites and sub_weights (kinases x universe) counts each kinase's links to them.
+def substrateWeights(link_site, link_kin, n_kin):
+    universe, uni_pos = np.unique(link_site, return_inverse=True)
+    sub_weights = np.zeros((n_kin, len(universe)), dtype=int)
+    np.add.at(sub_weights, (link_kin, uni_pos), 1)
+
+    return universe, sub_weights
+
+# Two-sample Kolmogorov-Smirnov tests are run for all kinases and samples in one batch.
+# values is a (universe x samples) matrix; sub_weights and nonsub_weights (kinases x universe) count how often each value is in a kinase's substrate and non-substrate samples.
+# Each sample's values are sorted once. The ECDFs of every kinase's two samples are then read from cumulative counts along that shared order.
+# The KS statistic is the largest ECDF distance, taken at the last position of each group of tied values.
+# p-values are those of scipy's ks_2samp with its default method: computed exactly by scipy when neither sample has more than KS_EXACT_MAX values,
+# and otherwise taken from the asymptotic two-sided Smirnov distribution.
+# Exact p-values only depend on the two sample sizes and the statistic, so ks_2samp is only called once for each distinct statistic
+# among the kinases with the same sample sizes, across all samples.
+# Kinases are processed in chunks to bound memory use.
+# Samples are independent and are tested in parallel by up to workers threads (COLUMN_WORKERS by default).
+# The chunk size is divided between the threads, so that memory use stays the same.
+def ksTests(values, sub_weights, nonsub_weights, chunk=256, workers=None):
+    n_kin = sub_weights.shape[0]
+    n_sub = sub_weights.sum(axis=1)
+    n_nonsub = nonsub_weights.sum(axis=1)
+    if n_kin > 0 and (n_sub.min() == 0 or n_nonsub.min() == 0):
+        raise ValueError('Data passed to ks_2samp must not be empty')
+    n_cols = values.shape[1]
+    workers = min(COLUMN_WORKERS if workers is None else workers, n_cols)
+    if workers > 1:
+        chunk = max(16, chunk // workers)
+
+    # Each sample writes only its own column of ks_stats.
+    ks_stats = np.zeros((n_kin, n_cols))
+    def testColumn(col):
+        order = np.argsort(values[:, col], kind='stable')
+        ordered = values[order, col]
+        ends = np.append(ordered[1:] != ordered[:-1], True)
+        for start in range(0, n_kin, chunk):
+            stop = min(start + chunk, n_kin)
+            sub_cdf = np.cumsum(sub_weights[start:stop, order], axis=1)[:, ends] / n_sub[start:stop].reshape(-1, 1)
+            nonsub_cdf = np.cumsum(nonsub_weights[start:stop, order], axis=1)[:, ends] / n_nonsub[start:stop].reshape(-1, 1)
+            ks_stats[start:stop, col] = np.abs(sub_cdf - nonsub_cdf).max(axis=1, initial=0)
+        # As in scipy, a missing value in either sample makes the test result missing.
+        missing = np.isnan(values[:, col])
+        if missing.any():
+            affected = (sub_weights[:, missing] + nonsub_weights[:, missing]).sum(axis=1) > 0
+            ks_stats[affected, col] = np.nan
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(testColumn, range(n_cols)))
+    else:
+        for col in range(n_cols):
+            testColumn(col)
+
+    en = np.round(n_sub * n_nonsub / (n_sub + n_nonsub).astype(float))
+    pvals = np.clip(st.kstwo.sf(ks_stats, en.reshape(-1, 1)), 0, 1)
+    exact = np.maximum(n_sub, n_nonsub) <= KS_EXACT_MAX
+    for n1, n2 in set(zip(n_sub[exact].tolist(), n_nonsub[exact].tolist())):
+        kins = np.flatnonzero((n_sub == n1) & (n_nonsub == n2))
+        # Statistics are multiples of 1/lcm(n1, n2). Each distinct multiple is tested once, with the samples of one kinase and sample that gave it.
+        lattice = np.round(ks_stats[kins] * (n1 // math.gcd(n1, n2) * n2))
+        group_pvals = pvals[kins]
+        for h in np.unique(lattice[~np.isnan(lattice)]):
+            same = lattice == h
+            kin, col = np.argwhere(same)[0]
+            sub = np.repeat(values[:, col], sub_weights[kins[kin]])
+            nonsub = np.repeat(values[:, col], nonsub_weights[kins[kin]])
+            group_pvals[same] = st.ks_2samp(sub, nonsub).pvalue
+        pvals[kins] = group_pvals
+
+    return ks_stats, pvals
+
+# Empirical p-values are (1 + number of permutations at least as extreme as observed) / (1 + permutations), so they are never 0.
+# Statistics are compared with a small relative tolerance, so that permutations reproducing the observed statistic count as extreme.
+def empiricalCount(null, observed):
+    return null >= observed - 1e-9 * np.abs(observed) - 1e-12
+
+# The first size positions of n_perm independent random permutations of range(n), as an (n_perm x size) array.
+# A partial Fisher-Yates shuffle is run for all permutations at once, so only size vectorised steps are needed.
+def partialPermutations(rng, n, size, n_perm):
+    pool = np.tile(np.arange(n), (n_perm, 1))
+    rows = np.arange(n_perm)
+    for i in range(size):
+        j = rng.integers(i, n, size=n_perm)
+        pool[rows, i], pool[rows, j] = pool[rows, j], pool[rows, i]
+
+    return pool[:, :size]
+
+# Kinases are grouped by their substrate weights (the number of links to each of their sites, usually m ones).
+# Under permutations of the site values, kinases of the same group share one null distribution.
+def weightGroups(sub_weights):
+    groups = {}
+    for kin in range(sub_weights.shape[0]):
+        weights = np.sort(sub_weights[kin][sub_weights[kin] > 0])[::-1]
+        groups.setdefault(tuple(weights), []).append(kin)
+
+    return groups
+
+# Empirical z-test p-values, from permutations of the site labels against the kinase incidence structure.
+# Each permutation reassigns the values of all phosphosites in a sample to the sites at random. The mean and standard deviation
+# of the sample do not change, so a kinase's z-score only depends on the weighted sum of the values drawn for its m substrates.
+# For a block of permutations, the values drawn for the largest group form a (permutations x sites) matrix, and the null sums of
+# every group are the product of its first m columns with the group's weights.
+# As with the normal p-values, the tail is the one the observed z-score falls in. Samples with missing values have missing p-values.
+def zPermutations(matrix, link_site, link_kin, n_kin, z, permutations, seed=PERMUTATION_SEED):
+    n_sites, n_cols = matrix.shape
+    universe, sub_weights = substrateWeights(link_site, link_kin, n_kin)
+    groups = weightGroups(sub_weights)
+    observed = sub_weights @ matrix[universe]
+    upper = np.zeros((n_kin, n_cols))
+    lower = np.zeros((n_kin, n_cols))
+    rng = np.random.default_rng(seed)
+    max_sub = max([len(weights) for weights in groups] + [0])
+    block = max(1, PERMUTATION_BLOCK // (16 * max(n_sites, 1)))
+    for start in range(0, permutations, block):
+        n_perm = min(block, permutations - start)
+        positions = partialPermutations(rng, n_sites, max_sub, n_perm)
+        for col in range(n_cols):
+            drawn = matrix[positions, col]
+            for weights, kins in groups.items():
+                null = (drawn[:, :len(weights)] @ np.array(weights, dtype=float)).reshape(1, -1)
+                kin_sums = observed[kins, col].reshape(-1, 1)
+                upper[kins, col] += empiricalCount(null, kin_sums).sum(axis=1)
+                lower[kins, col] += empiricalCount(-null, -kin_sums).sum(axis=1)
+    pvals = (1 + np.where(z < 0, lower, upper)) / (1.0 + permutations)
+    pvals[np.isnan(z)] = np.nan
+
+    return pvals
+
+# Empirical KS p-values, from permutations of the matched phosphosite values against the kinase incidence structure.
+# A permutation places each kinase's substrate weights at random positions of the sorted values of a sample, so the null distribution
+# of a kinase's KS statistic only depends on its substrate weights (usually m ones) and the tied values of the sample.
+# Kinases with the same weights (see weightGroups) share one simulated null distribution, and all groups share the random positions of a block of permutations.
+# The ECDF distance only needs to be read at the substrates: its positive side is largest at the end of a substrate's group of tied values,
+# its negative side at the end of the group before it. Each permutation therefore costs O(m) per group instead of a walk over all sites.
+# ks_stats are the observed (unsigned) statistics from ksTests. Missing statistics have missing p-values.
+def ksPermutations(values, sub_weights, ks_stats, permutations, seed=PERMUTATION_SEED):
+    n_kin, n_uni = sub_weights.shape
+    n_cols = values.shape[1]
+    groups = weightGroups(sub_weights)
+    # First and last position of the group of tied values at each position of a sample's sorted values.
+    starts = []
+    ends = []
+    for col in range(n_cols):
+        ordered = np.sort(values[:, col], kind='stable')
+        first = np.append(True, ordered[1:] != ordered[:-1])
+        group = np.cumsum(first) - 1
+        group_start = np.flatnonzero(first)
+        starts.append(group_start[group])
+        ends.append((np.append(group_start[1:], n_uni) - 1)[group])
+
+    counts = np.zeros((n_kin, n_cols))
+    rng = np.random.default_rng(seed)
+    max_sub = max([len(weights) for weights in groups] + [0])
+    block = max(1, PERMUTATION_BLOCK // (16 * max(n_uni, 1)))
+    for start in range(0, permutations, block):
+        n_perm = min(block, permutations - start)
+        positions = partialPermutations(rng, n_uni, max_sub, n_perm)
+        for weights, kins in groups.items():
+            m = len(weights)
+            n_sub = float(sum(weights))
+            n_nonsub = float(n_uni - m)
+            # Substrate j is placed at positions[:, j] of the sorted values. Substrates are ordered by position, with cumulative weights.
+            order = np.argsort(positions[:, :m], axis=1)
+            pos = np.take_along_axis(positions[:, :m], order, axis=1)
+            placed = np.array(weights, dtype=float)[order]
+            cum_weights = np.cumsum(placed, axis=1)
+            rank = np.arange(1, m + 1)
+            for col in range(n_cols):
+                above = cum_weights / n_sub - (ends[col][pos] + 1 - rank) / n_nonsub
+                below = (starts[col][pos] - (rank - 1)) / n_nonsub - (cum_weights - placed) / n_sub
+                null = np.maximum(np.maximum(above.max(axis=1), below.max(axis=1)), 0)
+                counts[kins, col] += empiricalCount(null.reshape(1, -1), ks_stats[kins, col].reshape(-1, 1)).sum(axis=1)
+    pvals = (1 + counts) / (1.0 + permutations)
+    pvals[np.isnan(ks_stats)] = np.nan
+
+    return pvals
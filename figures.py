@@ -0,0 +1,102 @@
+from io import StringIO, BytesIO
+
+# Plot formats that can be rendered and the accepted range of the plot size factor.
+PLOT_FORMATS = ["svg", "png"]
+MIN_PLOT_SIZE = 0.25
+MAX_PLOT_SIZE = 4.0
+
+# Multi-sample heatmaps with more cells (kinases x samples) than this are drawn as a single raster image (see rasterHeatmap), with values shown on hover.
+RASTER_CELLS = 5000
+# Size of one raster heatmap cell in inches (before scaling by the plot size factor).
+RASTER_CELL_HEIGHT = 0.12
+RASTER_CELL_WIDTH = 0.16
+
+# A finished matplotlib figure is written into a buffer and returned as SVG markup (a string) or PNG data (bytes).
+# With tight=False the figure keeps its exact size, so that positions within it can be computed from its layout.
+# The figure is closed afterwards to free its memory.
+def saveFigure(fig, fmt="svg", tight=True):
+    import matplotlib.pyplot as plt
+
+    bbox = "tight" if tight else None
+    if fmt == "png":
+        fig_file = BytesIO()
+        fig.savefig(fig_file, format='png', bbox_inches=bbox, dpi=150)
+        figure = fig_file.getvalue()
+    else:
+        fig_file = StringIO()
+        fig.savefig(fig_file, format='svg', bbox_inches=bbox)
+        # Retrieve the SVG element, without the XML header.
+        figure = '<svg' + fig_file.getvalue().split('<svg')[1]
+    # Free memory buffer and figure.
+    fig_file.close()
+    plt.close(fig)
+
+    return figure
+
+# The heatmap matrix of a multi-sample analysis is taken from its kinase scores dataframe.
+# stat is the prefix of the per-sample columns shown (e.g. "zSc."). Only kinases with at least min_sub substrates are kept.
+# Rows are kinases and columns are samples.
+def heatmapFrame(scores_df, stat, min_sub):
+    score_cols = [col for col in scores_df.columns if col.startswith(stat)]
+    heatmap_rows = scores_df["Sub.Count"] >= min_sub
+    heatmap_df = scores_df.loc[heatmap_rows, score_cols]
+    heatmap_df.columns = [col[len(stat):] for col in score_cols]
+    heatmap_df.index = scores_df.loc[heatmap_rows, "Kinase"]
+
+    return heatmap_df
+
+# Layout of a raster heatmap with n_rows kinases and n_cols samples.
+# Figure width and height are in inches. The heatmap's position (left, top, plot_width, plot_height) is given as fractions of the figure,
+# so that the browser can map a pointer position on the image to a heatmap cell.
+def rasterLayout(n_rows, n_cols, size=1.0):
+    # Cell size and the margins left for labels and the colour bar, in inches.
+    cell_height = RASTER_CELL_HEIGHT * size
+    cell_width = RASTER_CELL_WIDTH * size
+    leftmargin = 1.0
+    rightmargin = 1.0
+    topmargin = 1.0
+    bottommargin = 0.2
+    figwidth = leftmargin + rightmargin + n_cols*cell_width
+    figheight = topmargin + bottommargin + n_rows*cell_height
+
+    return {"width": figwidth, "height": figheight, "left": leftmargin/figwidth, "top": topmargin/figheight,
+            "plot_width": n_cols*cell_width/figwidth, "plot_height": n_rows*cell_height/figheight, "rows": n_rows, "cols": n_cols}
+
+# Large heatmaps are drawn directly from the score matrix as one image, without a text element or border per cell.
+# Kinase and sample labels are thinned out so that they remain legible. Cell values are looked up on hover instead of being annotated.
+def rasterHeatmap(heatmap_df, label, size=1.0, fmt="svg"):
+    import math
+    import numpy as np
+    import matplotlib as mpl
+    mpl.use('Agg')
+    import matplotlib.pyplot as plt
+
+    n_rows, n_cols = heatmap_df.shape
+    layout = rasterLayout(n_rows, n_cols, size)
+    fig = plt.figure(figsize=(layout["width"], layout["height"]))
+    bottom = 1 - layout["top"] - layout["plot_height"]
+    ax = fig.add_axes([layout["left"], bottom, layout["plot_width"], layout["plot_height"]])
+
+    # Plot the heatmap as an image with one pixel block per cell.
+    image = ax.imshow(heatmap_df.values, cmap='coolwarm', aspect='auto', interpolation='nearest')
+
+    # Label every k-th row and column, so that labels are at least 6pt apart.
+    row_step = max(1, math.ceil(6/72 / (RASTER_CELL_HEIGHT*size)))
+    col_step = max(1, math.ceil(6/72 / (RASTER_CELL_WIDTH*size)))
+    ax.xaxis.set_ticks_position('top')
+    ax.set_xticks(np.arange(0, n_cols, col_step))
+    ax.set_xticklabels(heatmap_df.columns[::col_step], rotation=90, fontsize=5)
+    ax.set_yticks(np.arange(0, n_rows, row_step))
+    ax.set_yticklabels(heatmap_df.index[::row_step], fontsize=5)
+    ax.tick_params(length=0)
+    for pos in ['right', 'top', 'left', 'bottom']:
+        ax.spines[pos].set_visible(False)
+
+    # Colour bar next to the heatmap.
+    cax = fig.add_axes([layout["left"] + layout["plot_width"] + 0.15/layout["width"], bottom, 0.12/layout["width"], layout["plot_height"]])
+    cb = fig.colorbar(image, cax=cax, orientation='vertical')
+    cb.ax.tick_params(labelsize=6)
+    cb.set_label(label, fontsize=6, labelpad=7)
+    cb.outline.set_visible(False)
+
+    return saveFigure(fig, fmt, tight=False)
@@ -0,0 +1,9 @@
+import os
+
+# Results and plots are long-polled (see RESULT_WAIT_TIMEOUT in appconfig.py): a waiting request holds its worker until the task finishes.
+# With sync workers a few waiting browsers would block every other request, so each worker process serves requests from a pool of threads.
+# The number of worker processes is taken from WEB_CONCURRENCY, as set by Heroku.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+# Worker timeout, matching the 30 second request timeout of the Heroku router.
+timeout = 30
@@ -1,33 +1,14 @@
-def userInput(ks_db, graphics, df, min_sub):
+def userInput(ks_db, graphics, df, min_sub, permutations=0):
 
-    import io
-    from io import StringIO
     import pandas as pd
-    import numpy as np
-    
-    if graphics == "yes":
-        import matplotlib as mpl
-        mpl.use('Agg')
-        import matplotlib.patches as mpatches
-        import matplotlib.pyplot as plt
-
-    # Function to calculate total number of known phosphosites in the database for a given kinase.
-    def getTotalSub(kinase):
-        counter=0
-        for x in ks_db:
-            db_kinase = x[1]
-            if kinase == db_kinase:
-                counter+=1
-        return counter
+    import profiling
+    import engine
     
     # Function to calculate the K-Score.
     def kScore(kin_sum, all_sum, sub_num, total_sub):
         kscore = (kin_sum/all_sum) * (sub_num/total_sub)**(1/2) * 10**6
         return kscore
 
-    # Convert JSON-string datatset back into a DF.
-    df = pd.read_json(df, orient="split")
-    
     # User data is passed from the server and parsed as appropriate.
     user_file=df.values.tolist()
     array=[]
@@ -78,19 +59,20 @@ def userInput(ks_db, graphics, df, min_sub):
         all_ints.append(dic[key])
     sum_ints=sum(all_ints)
 
-    # Each phosphosite substrate in dic is scanned against the PSP K-S db. 
+    profiling.mark("parse")
+
+    # Each phosphosite substrate in dic is looked up in the site-keyed index of the K-S db.
     # If a match is found, relevant information for that phosphosite is appended to a new array called ks_links.
+    kinases, links, link_site, link_kin = engine.matchSites(list(dic), ks_db)
     ks_links=[]
-    for x in dic:
-        for y in ks_db:
-            if x == y[0]:
-                ks_links.append([y[1], y[0], y[2], y[3], dic[x]])
-            else:
-                continue
+    for link in links:
+        ks_links.append(link + [dic[link[1]]])
 
     # The array is then converted into a dataframe to be viewed as a table.
     ks_links_df = pd.DataFrame(ks_links, columns=["Kinase", "Site", "Site.Seq(+/- 7AA)", "Source", "Ints"])
 
+    profiling.mark("match")
+
     # A dictionary containing unique kinases as keys and substrate intensities as values is created.
     # If the same kinase was identified for multiple substrates, multiple intensities are appended to the dictionary values.
     kinase_dic={}
@@ -104,8 +86,8 @@ def userInput(ks_db, graphics, df, min_sub):
 
     # The dictionary is used to calculate the number of substrates identified for each kinase.
     # It also calculates the sum of intensities across each kinase's substrates.
-    # A predefined function computes the total substrate count in the PSP db for each kinase.
-    # The algorithm then computes the k-score.
+    # The total substrate count in the DB for each kinase is read from the precomputed table.
+    # The algorithm then computes the k-score. K-scores have no p-values, so permutations is not used.
     # All information is appended to a new array.
     kscore_info=[]
     for kinase in kinase_dic:
@@ -113,8 +95,8 @@ def userInput(ks_db, graphics, df, min_sub):
         substrate_num = len(kinase_dic[kinase])
         # Sum of intensities of phosphosites associated with a given kinase.
         kin_ints_sum = sum(kinase_dic[kinase])
-        # Total number of sites in the PSP database for a given kinase.
-        total_sub_num = getTotalSub(kinase)
+        # Total number of sites in the database for a given kinase.
+        total_sub_num = ks_db["totals"][kinase]
         # Kinase 'K-Score' is calculated here.
         kscore = kScore(kin_ints_sum, sum_ints, substrate_num, total_sub_num)
         # An array contains all relevant k-score information for each kinase. 
@@ -123,73 +105,79 @@ def userInput(ks_db, graphics, df, min_sub):
     # k-score information array is converted into a dataframe.
     kscore_df=pd.DataFrame(kscore_info, columns=["Kinase", "Sub.Count", "Total.Sub.Count", "Sum.Ints", "kSc"])
 
+    profiling.mark("statistics")
+
     # Barplot only generated if the user chose to produce graphics during file upload.
+    # Otherwise it can be rendered later from the kinase scores with plotScores.
     if graphics == "no":
         svg_fig = "Barplot was not generated for this analysis."
     elif graphics == "yes":
-        # The array is sorted in an ascending order to make list manipulaton for plot generation easier.
-        kscore_info.sort(key=lambda x: float(x[4]))
-
-        # Kinase label for y-axis.
-        kinases = []
-
-        # Corresponding k-scores.
-        score_list = []
-
-        # Extraction of desirable results that match user_defined parameters.
-        # min_sub denotes the minimum substrate count per kinase indicated by the user.
-        for entry in kscore_info:
-            kin=entry[0]
-            sub=entry[1]
-            score = entry[4]
-            if sub >= min_sub:
-                kinases.append(kin)
-                score_list.append(score)
-
-        # Generate an array of sequence to be used to plot the y-axis values.
-        y_pos = np.arange(len(kinases))
-        n=len(y_pos)
-
-        # Set the margins and bar height for a single category.
-        topmargin = 0.1 #inches
-        bottommargin = 0.1 #inches
-        categorysize = 0.15 # inches
-
-        # Calculate a dynamic figure height based on the known values above.
-        figheight = topmargin + bottommargin + (n+1)*categorysize
-
-        # Figure box and axes are plotted here.
-        fig, ax = plt.subplots(figsize=(5, figheight))
-
-        # Horizontal bars are generated.
-        ax.barh(y_pos, score_list, color="#b3b3b3")
-
-        # Y-axis limit to reduce the top and bottom margin white spaces.
-        plt.ylim(min(y_pos)-1, max(y_pos)+1)
-
-        # Barplot is styled and labelled.
-        ax.set_yticks(y_pos)
-        ax.set_yticklabels(kinases)
-        for pos in ['right','top', 'left']:
-            ax.spines[pos].set_visible(False)
-        ax.tick_params(left=False)
-        plt.yticks(fontsize=6)
-        plt.xticks(fontsize=6)
-        plt.ylabel("Kinase", fontsize=6)
-        plt.xlabel("K-score", fontsize=6)
-
-        # Create a StringIO object and use it to write SVG figure data to string buffer.
-        fig_file = StringIO()
-        fig.savefig(fig_file, format='svg', bbox_inches="tight")
-        # Seek beginning of the figure file.
-        fig_file.seek(0)
-        # Retrieve figure contents as a string.
-        svg_fig = '<svg' + fig_file.getvalue().split('<svg')[1]
-        # Free memory buffer.
-        fig_file.close()
-    
+        svg_fig = plotScores(kscore_df, min_sub)
+
+    profiling.mark("plot")
+
     # Convert results DFs into JSON strings.
     kscore_df = kscore_df.to_json(orient='split')
     ks_links_df = ks_links_df.to_json(orient='split')
     
-    return kscore_df, ks_links_df, svg_fig
\ No newline at end of file
+    profiling.mark("serialize")
+
+    return kscore_df, ks_links_df, svg_fig
+
+# The barplot of kinase k-scores is rendered from the kinase scores dataframe.
+# Only kinases with at least min_sub substrates are shown. size scales the figure and fmt is "svg" or "png".
+def plotScores(kscore_df, min_sub, size=1.0, fmt="svg"):
+
+    import numpy as np
+    import matplotlib as mpl
+    mpl.use('Agg')
+    import matplotlib.pyplot as plt
+    from figures import saveFigure
+
+    # The kinases are sorted in an ascending order of k-score to make plot generation easier.
+    kscore_df = kscore_df.sort_values("kSc", kind="mergesort")
+
+    # Extraction of desirable results that match user-defined parameters.
+    # min_sub denotes the minimum substrate count per kinase indicated by the user.
+    plot_df = kscore_df[kscore_df["Sub.Count"] >= min_sub]
+
+    # Kinase label for y-axis.
+    kinases = plot_df["Kinase"].tolist()
+
+    # Corresponding k-scores.
+    score_list = plot_df["kSc"].tolist()
+
+    # Generate an array of sequence to be used to plot the y-axis values.
+    y_pos = np.arange(len(kinases))
+    n=len(y_pos)
+
+    # Set the margins and bar height for a single category.
+    topmargin = 0.1 #inches
+    bottommargin = 0.1 #inches
+    categorysize = 0.15 # inches
+
+    # Calculate a dynamic figure height based on the known values above.
+    figheight = topmargin + bottommargin + (n+1)*categorysize
+
+    # Figure box and axes are plotted here.
+    fig, ax = plt.subplots(figsize=(5*size, figheight*size))
+
+    # Horizontal bars are generated.
+    ax.barh(y_pos, score_list, color="#b3b3b3")
+
+    # Y-axis limit to reduce the top and bottom margin white spaces.
+    plt.ylim(min(y_pos)-1, max(y_pos)+1)
+
+    # Barplot is styled and labelled.
+    ax.set_yticks(y_pos)
+    ax.set_yticklabels(kinases)
+    for pos in ['right','top', 'left']:
+        ax.spines[pos].set_visible(False)
+    ax.tick_params(left=False)
+    plt.yticks(fontsize=6)
+    plt.xticks(fontsize=6)
+    plt.ylabel("Kinase", fontsize=6)
+    plt.xlabel("K-score", fontsize=6)
+
+    # The figure is returned as SVG markup or PNG data.
+    return saveFigure(fig, fmt)
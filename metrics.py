@@ -0,0 +1,101 @@
+import re
+import time
+
+# Operational metrics in the Prometheus text format.
+# The web app and the Celery workers run in separate processes, so histograms and counters are kept in Redis,
+# where every process adds its observations and the /metrics view reads them back.
+METRICS_PREFIX = "metrics:"
+COUNTERS_KEY = METRICS_PREFIX + "counters"
+# Sorted set of queued task ids scored by the time they were sent, used for wait times and the age of the oldest queued task.
+ENQUEUED_KEY = METRICS_PREFIX + "enqueued"
+# Queued tasks older than this (seconds) are assumed lost and no longer counted.
+ENQUEUED_MAX_AGE = 24 * 3600
+
+# Histogram buckets: task durations in seconds and payload sizes in bytes.
+SECONDS_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+BYTES_BUCKETS = [10**4, 10**5, 10**6, 10**7, 10**8]
+
+# Histograms and counters: metric name -> (help text, buckets).
+HISTOGRAMS = {
+    "ksea_task_wait_seconds": ("Time tasks spent queued before a worker started them.", SECONDS_BUCKETS),
+    "ksea_task_run_seconds": ("Time workers spent running tasks.", SECONDS_BUCKETS),
+    "ksea_result_bytes": ("Stored size of analysis results (scores, links and plot), after compression.", BYTES_BUCKETS),
+}
+COUNTERS = {
+    "ksea_tasks_total": "Finished tasks by outcome.",
+}
+
+# Labels are written in the order given, e.g. task="runAlg",algorithm="ks_multi",database="psp".
+def labelString(labels):
+    return ",".join(name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for name, value in labels.items())
+
+# One observation is added to a histogram. Buckets are cumulative, as in the exposition format.
+def observe(client, name, labels, value):
+    key = METRICS_PREFIX + name
+    series = labelString(labels)
+    pipe = client.pipeline()
+    for bucket in HISTOGRAMS[name][1]:
+        if value <= bucket:
+            pipe.hincrby(key, series + "\t" + str(bucket), 1)
+    pipe.hincrby(key, series + "\t+Inf", 1)
+    pipe.hincrbyfloat(key, series + "\tsum", value)
+    pipe.execute()
+
+def increment(client, name, labels, amount=1):
+    client.hincrby(COUNTERS_KEY, name + "{" + labelString(labels) + "}", amount)
+
+# Tasks are timed from the moment they are sent to the broker until a worker starts them.
+def taskSent(client, task_id):
+    client.zadd(ENQUEUED_KEY, {task_id: time.time()})
+
+# The wait time of a task that a worker has just started, or None if its sending was not recorded (e.g. eager tasks).
+def taskStarted(client, task_id):
+    sent = client.zscore(ENQUEUED_KEY, task_id)
+    client.zrem(ENQUEUED_KEY, task_id)
+    return None if sent is None else max(time.time() - sent, 0.0)
+
+# Age in seconds of the oldest task still waiting in the queue, or 0 if none is waiting.
+def oldestQueued(client):
+    now = time.time()
+    client.zremrangebyscore(ENQUEUED_KEY, 0, now - ENQUEUED_MAX_AGE)
+    oldest = client.zrange(ENQUEUED_KEY, 0, 0, withscores=True)
+    return now - oldest[0][1] if oldest else 0.0
+
+# Number and total size of the user sessions held in the key-value store. Session keys are serialised as <hex id>_<hex time>.
+# This scans the keyspace, which is fine for scrape intervals of tens of seconds.
+SESSION_KEY = re.compile(rb"^[0-9a-f]+_[0-9a-f]+$")
+def sessionSizes(client):
+    count = 0
+    size = 0
+    for key in client.scan_iter(match="*_*", count=1000):
+        if SESSION_KEY.match(key):
+            count += 1
+            size += client.strlen(key)
+    return count, size
+
+# Histograms and counters stored in Redis, followed by the given gauges, in the Prometheus text format.
+# gauges is a list of (name, help text, value).
+def exposition(client, gauges):
+    lines = []
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " histogram")
+        fields = dict((k.decode("utf-8"), v) for k, v in client.hgetall(METRICS_PREFIX + name).items())
+        for series in sorted(set(field.split("\t")[0] for field in fields)):
+            sep = "," if series else ""
+            for bucket in [str(b) for b in buckets] + ["+Inf"]:
+                lines.append(name + "_bucket{" + series + sep + 'le="' + bucket + '"} ' + str(int(fields.get(series + "\t" + bucket, 0))))
+            lines.append(name + "_sum{" + series + "} " + str(float(fields.get(series + "\tsum", 0))))
+            lines.append(name + "_count{" + series + "} " + str(int(fields.get(series + "\t+Inf", 0))))
+    counters = dict((k.decode("utf-8"), int(v)) for k, v in client.hgetall(COUNTERS_KEY).items())
+    for name, help_text in COUNTERS.items():
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " counter")
+        for series in sorted(series for series in counters if series.startswith(name + "{")):
+            lines.append(series + " " + str(counters[series]))
+    for name, help_text, value in gauges:
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " gauge")
+        lines.append(name + " " + str(value))
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,99 @@
+import importlib
+
+import pandas as pd
+
+import engine
+import profiling
+
+# Database key of analyses run against all K-S databases in one job.
+ALL_DATABASES = "all"
+# Column naming the database of each row of combined results.
+DATABASE_COLUMN = "Database"
+# Name of the result table (artifact) holding the kinase scores of every database, one row per kinase and database.
+DATABASE_SCORES = "database_scores"
+
+# Algorithms are run with their multi-sample implementation, which gives the same statistics for single-sample datasets.
+def multiScript(script):
+    return script.split("_")[0] + "_multi"
+
+# Algorithm run for a job against a database key. Uploads and batch jobs map it the same way, so that identical analyses share
+# their result cache key and stored script.
+def jobScript(script, db_key):
+    return multiScript(script) if db_key == ALL_DATABASES else script
+
+# One dataset is analysed with one algorithm against several K-S databases in a single job.
+# The upload is parsed once (splitting phosphosites and averaging duplicates). Each database then only matches the parsed phosphosites
+# against its site index and scores the kinases. ks_dbs maps database keys to loaded databases, in the order of the comparison.
+# Returns, like the algorithms' userInput, kinase scores, kinase-substrate links and a message in place of a plot, followed by further tables:
+#   - the kinase scores are the side-by-side comparison (see compareScores), so they are browsed and plotted like multi-sample scores,
+#   - the links of all databases are combined, with a database column,
+#   - DATABASE_SCORES holds the kinase scores of all databases, with a database column.
+def userInput(ks_dbs, script, df, permutations=0):
+    mod = importlib.import_module(multiScript(script))
+
+    samples, sites, matrix = engine.parseSamples(df, omit_no_mod=mod.OMIT_NO_MOD)
+
+    profiling.mark("parse")
+
+    matches = [(db_key, engine.matchSites(sites, ks_db)) for db_key, ks_db in ks_dbs.items()]
+
+    profiling.mark("match")
+
+    # A database the algorithm cannot score (e.g. KS when a kinase is linked to every matched phosphosite) does not fail the others.
+    # It is scored as if no phosphosite matched, so its statistics are missing from the comparison, and its error is reported in the message.
+    # The job only fails if no database could be scored.
+    scores = {}
+    links = []
+    errors = []
+    for db_key, matched in matches:
+        try:
+            scores[db_key], db_links = mod.scoreSites(ks_dbs[db_key], samples, matrix, matched, permutations)
+        except (ValueError, TypeError) as e:
+            if len(errors) == len(matches) - 1:
+                raise
+            errors.append(db_key + ": " + str(e))
+            scores[db_key], db_links = mod.scoreSites(ks_dbs[db_key], samples, matrix, engine.matchSites([], ks_dbs[db_key]), permutations)
+        db_links.insert(0, DATABASE_COLUMN, db_key)
+        links.append(db_links)
+    comparison_df = compareScores(scores, samples, mod.SAMPLE_STATS)
+    scores_df = pd.concat([db_scores.assign(**{DATABASE_COLUMN: db_key}) for db_key, db_scores in scores.items()], ignore_index=True)
+    scores_df = scores_df[[DATABASE_COLUMN] + [col for col in scores_df.columns if col != DATABASE_COLUMN]]
+    links_df = pd.concat(links, ignore_index=True)
+
+    profiling.mark("statistics")
+
+    comparison_df = comparison_df.to_json(orient='split')
+    links_df = links_df.to_json(orient='split')
+    scores_df = scores_df.to_json(orient='split')
+
+    profiling.mark("serialize")
+
+    message = "Heatmap was not generated for this analysis."
+    if errors:
+        message += " Kinases could not be scored against " + "; ".join(errors) + "."
+
+    return comparison_df, links_df, message, {DATABASE_SCORES: scores_df}
+
+# Kinase scores of several databases are laid out side by side, one row per kinase found in any of them.
+# Every (sample, database) pair is treated as a sample named <sample>.<database>, so the table has the column layout of multi-sample scores:
+# per-sample statistics are ordered by sample and then database, which places each sample's results of the databases next to each other.
+# Sub.Count is the largest substrate count of the kinase in any database (used by min_sub to choose the kinases plotted),
+# and the count of each database follows as Sub.Count.<database> (and Total.Sub.Count.<database> for KARP).
+# Statistics of kinases not found in a database are missing.
+def compareScores(scores, samples, sample_stats):
+    kinases = list(dict.fromkeys(kinase for db_scores in scores.values() for kinase in db_scores["Kinase"]))
+    indexed = dict((db_key, db_scores.set_index("Kinase").reindex(kinases)) for db_key, db_scores in scores.items())
+    comparison_df = pd.DataFrame({"Kinase": kinases})
+    comparison_df["Sub.Count"] = pd.concat([db_scores["Sub.Count"] for db_scores in indexed.values()], axis=1).max(axis=1).fillna(0).astype(int).values
+    first = next(iter(indexed.values()))
+    count_cols = [col for col in first.columns if col.endswith("Sub.Count")]
+    columns = {}
+    for col in count_cols:
+        for db_key, db_scores in indexed.items():
+            columns[col + "." + db_key] = db_scores[col].fillna(0).astype(int).values
+    for sample in samples:
+        for db_key, db_scores in indexed.items():
+            for stat in sample_stats:
+                columns[stat + sample + "." + db_key] = db_scores[stat + sample].values
+
+    return pd.concat([comparison_df, pd.DataFrame(columns)], axis=1)
@@ -0,0 +1,131 @@
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Per-stage instrumentation of analysis tasks.
+# While a task is being recorded, the algorithms call mark() at the end of each stage (parsing, matching, statistics, plotting, serialisation).
+# Each stage records its wall time and a peak memory figure, measured in one of two ways (memory):
+#   "rss": how far the stage raised the peak resident memory of the process. Costs nothing, and as each Celery worker process
+#          runs a single task (CELERYD_MAX_TASKS_PER_CHILD = 1) it shows the memory each stage needs on top of the earlier ones.
+#   "tracemalloc": the peak memory allocated by Python during the stage. Exact per stage, but slows down the analysis several times.
+# With memory=None only wall times are recorded. Outside a recording, e.g. in the benchmark, mark() does nothing.
+_local = threading.local()
+
+# Redis key prefix of the aggregated stage statistics. One hash per algorithm and database.
+STAGE_PREFIX = "stage-stats:"
+
+# Peak resident memory of the process in bytes (reported in kilobytes on Linux and in bytes on macOS).
+def peakRss():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class StageRecorder:
+    def __init__(self, memory="rss"):
+        self.memory = memory
+        self.stages = []
+        self.started_tracing = False
+
+    def start(self):
+        if self.memory == "tracemalloc":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            tracemalloc.reset_peak()
+            self.baseline = tracemalloc.get_traced_memory()[0]
+        elif self.memory == "rss":
+            self.baseline = peakRss()
+        self.last = time.perf_counter()
+
+    # The stage that has just finished is recorded.
+    def mark(self, name):
+        stage = {"stage": name, "seconds": time.perf_counter() - self.last}
+        if self.memory == "tracemalloc":
+            # Peak memory is counted above the memory in use when the stage started.
+            current, peak = tracemalloc.get_traced_memory()
+            stage["peak_bytes"] = max(peak - self.baseline, 0)
+            tracemalloc.reset_peak()
+            self.baseline = current
+        elif self.memory == "rss":
+            peak = peakRss()
+            stage["peak_bytes"] = peak - self.baseline
+            self.baseline = peak
+        self.stages.append(stage)
+        self.last = time.perf_counter()
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+
+# Stages are recorded for the code run inside this block, in the current thread.
+@contextmanager
+def recording(memory="rss"):
+    recorder = StageRecorder(memory)
+    _local.recorder = recorder
+    recorder.start()
+    try:
+        yield recorder
+    finally:
+        _local.recorder = None
+        recorder.stop()
+
+# Marks the end of a stage of the current recording, if any.
+def mark(name):
+    recorder = getattr(_local, "recorder", None)
+    if recorder is not None:
+        recorder.mark(name)
+
+# Recorded stages are summarised on one line for the task log.
+def formatStages(stages):
+    parts = []
+    for stage in stages:
+        part = stage["stage"] + "=" + "%.3fs" % stage["seconds"]
+        if "peak_bytes" in stage:
+            part += "/" + "%.1fMB" % (stage["peak_bytes"] / 1048576.0)
+        parts.append(part)
+    return " ".join(parts)
+
+# The stages of a run are added to running totals per algorithm and database:
+# number of runs, total and maximum seconds, total and maximum peak memory of every stage.
+def recordStages(client, alg, db_key, stages):
+    key = STAGE_PREFIX + alg + ":" + db_key
+    pipe = client.pipeline()
+    for stage in stages:
+        name = stage["stage"]
+        pipe.hincrby(key, name + ":count", 1)
+        pipe.hincrbyfloat(key, name + ":seconds", stage["seconds"])
+        if "peak_bytes" in stage:
+            pipe.hincrby(key, name + ":peak_bytes", stage["peak_bytes"])
+    pipe.execute()
+    # Maxima are updated by comparison. Concurrent runs may occasionally lose an update, which is acceptable for monitoring.
+    previous = client.hgetall(key)
+    for stage in stages:
+        for field, value in [(stage["stage"] + ":max_seconds", stage["seconds"]), (stage["stage"] + ":max_peak_bytes", stage.get("peak_bytes"))]:
+            if value is not None and value > float(previous.get(field.encode("utf-8"), 0)):
+                client.hset(key, field, value)
+
+# Aggregated stage statistics by algorithm and database, with mean and maximum time and peak memory per stage.
+def stageStats(client):
+    stats = {}
+    for key in client.scan_iter(STAGE_PREFIX + "*"):
+        alg, db_key = key.decode("utf-8")[len(STAGE_PREFIX):].split(":", 1)
+        fields = dict((k.decode("utf-8"), float(v)) for k, v in client.hgetall(key).items())
+        stages = {}
+        for field, value in fields.items():
+            name, measure = field.rsplit(":", 1)
+            stages.setdefault(name, {})[measure] = value
+        summary = {}
+        for name, measures in stages.items():
+            count = measures.get("count", 0)
+            if count == 0:
+                continue
+            summary[name] = {"count": int(count), "mean_seconds": measures.get("seconds", 0) / count, "max_seconds": measures.get("max_seconds", 0),
+                             "total_seconds": measures.get("seconds", 0)}
+            if "peak_bytes" in measures:
+                summary[name]["mean_peak_bytes"] = measures["peak_bytes"] / count
+                summary[name]["max_peak_bytes"] = int(measures.get("max_peak_bytes", 0))
+        stats.setdefault(alg, {})[db_key] = summary
+
+    return stats
@@ -0,0 +1,54 @@
+import hashlib
+import json
+import time
+
+# Redis keys used by the result cache.
+# Each cached result is stored under RESULT_PREFIX + key. INDEX_KEY is a sorted set of cache keys scored by last use.
+RESULT_PREFIX = "result-cache:entry:"
+INDEX_KEY = "result-cache:index"
+HITS_KEY = "result-cache:hits"
+MISSES_KEY = "result-cache:misses"
+
+# A content-addressed cache key is computed from the uploaded file bytes, the database key and version,
+# the algorithm and the number of permutations for empirical p-values (0 for none).
+# Identical submissions therefore always map to the same key. Plot parameters (min_sub, graphics) are not part of the key:
+# they do not change the statistics, and plots are drawn from the cached scores, so submissions differing only in them share a result.
+def resultKey(file_bytes, db_key, db_version, alg, permutations=0):
+    params = [db_key, db_version, alg]
+    if permutations:
+        params.append(permutations)
+    digest = hashlib.sha256()
+    digest.update(file_bytes)
+    digest.update(json.dumps(params).encode("utf-8"))
+    return digest.hexdigest()
+
+# A cached result is looked up and counted as a hit or a miss.
+# Hits refresh the entry's position in the index, so the least recently used entries are evicted first.
+def getResult(client, key):
+    cached = client.get(RESULT_PREFIX + key)
+    if cached is None:
+        # The entry may have expired through its TTL, in which case it is also dropped from the index.
+        client.zrem(INDEX_KEY, key)
+        client.incr(MISSES_KEY)
+        return None
+    client.incr(HITS_KEY)
+    client.zadd(INDEX_KEY, {key: time.time()})
+    return json.loads(cached)
+
+# A result is stored with a TTL (seconds or a timedelta). If the cache holds more than max_size entries, the least recently used ones are evicted.
+def putResult(client, key, result, max_size, ttl):
+    client.set(RESULT_PREFIX + key, json.dumps(list(result)), ex=ttl)
+    client.zadd(INDEX_KEY, {key: time.time()})
+    excess = client.zcard(INDEX_KEY) - max_size
+    if excess > 0:
+        for old_key, score in client.zpopmin(INDEX_KEY, excess):
+            if isinstance(old_key, bytes):
+                old_key = old_key.decode("utf-8")
+            client.delete(RESULT_PREFIX + old_key)
+
+# Hit/miss counters and the number of cached entries, used to size the cache.
+def cacheStats(client):
+    hits = int(client.get(HITS_KEY) or 0)
+    misses = int(client.get(MISSES_KEY) or 0)
+    lookups = hits + misses
+    return {"hits": hits, "misses": misses, "hit_rate": hits / float(lookups) if lookups else 0.0, "entries": client.zcard(INDEX_KEY)}
@@ -1,25 +1,42 @@
-import io
-from io import StringIO, BytesIO
+from io import BytesIO
 import os
 import sys
-from datetime import timedelta
 import importlib
+import uuid
+import time
+import base64
+import hmac
+import json
 import pandas as pd
 import urllib.parse
 
 import redis
-from flask import Flask, flash, render_template, url_for, session, redirect, request, send_file, send_from_directory, jsonify
+from flask import Flask, flash, render_template, url_for, session, redirect, request, send_file, send_from_directory, jsonify, abort, Response
 from flask_kvsession import KVSessionExtension
 from simplekv.memory.redisstore import RedisStore
 
 from flask_wtf import FlaskForm
 from wtforms import SelectField, IntegerField
 
-from databases import uploadPSP, uploadPDTS, uploadEDGES
+from databases import loadDatabase, sourceChecksum
+from datasets import packDataset, unpackDataset
+from resultcache import resultKey, getResult, putResult, cacheStats
+from tables import tablePage, tableColumns
+from artifacts import putArtifacts, putArtifact, getArtifact, plotName
+from figures import PLOT_FORMATS, MIN_PLOT_SIZE, MAX_PLOT_SIZE, RASTER_CELLS, heatmapFrame, rasterLayout
+from downloads import FORMATS, binaryFormats, textChunks, gzipChunks, binaryTable
 import appconfig
-from celery import Celery
-from celery.result import AsyncResult
-from celery.signals import task_postrun
+import engine
+import profiling
+from profiling import recording, recordStages, stageStats, formatStages
+import metrics
+from batches import batchJobs, mergeJobs, putBatch, getBatch, markStored
+import multidb
+from multidb import ALL_DATABASES, DATABASE_SCORES
+from celery import Celery, states, group
+from celery.exceptions import TimeoutError as CeleryTimeoutError
+from celery.signals import task_postrun, task_prerun, before_task_publish
+from celery.utils.log import get_task_logger
 
 # Set of allowed file extensions.
 ALLOWED_EXTENSIONS = set(['tsv'])
@@ -28,7 +45,8 @@ sys.path.append(os.getcwd())
 
 # Create a redis instance with connection pool.
 redis_url = urllib.parse.urlparse(appconfig.REDIS_URL)
-store = RedisStore(redis.StrictRedis(host = redis_url.hostname, port = redis_url.port, password = redis_url.password, db = 0, socket_connect_timeout = 30, socket_timeout = 30, socket_keepalive=True, retry_on_timeout=True, health_check_interval=55))
+redis_client = redis.StrictRedis(host = redis_url.hostname, port = redis_url.port, password = redis_url.password, db = 0, socket_connect_timeout = 30, socket_timeout = 30, socket_keepalive=True, retry_on_timeout=True, health_check_interval=55)
+store = RedisStore(redis_client)
 app = Flask(__name__)
 KVSessionExtension(store, app)
 
@@ -68,12 +86,74 @@ app.config.update(
     BROKER_CONNECTION_MAX_RETRIES = None
 )
 celery = make_celery(app)
+logger = get_task_logger(__name__)
 
 # Create a celery task for ksea analyses to run in background.
+# Only the database key (e.g. "psp") is sent with the task. The indexed database is resolved from db_map,
+# which every worker process loads once at start-up.
+# Likewise, only the key of the uploaded dataset is sent. The packed dataset is read from Redis and removed once no job needs it.
+# Results are added to the result cache under cache_key, so that identical submissions can skip the analysis.
+# Plots are not drawn here. They are rendered on demand from the stored kinase scores by renderPlot,
+# so the plot parameters (min_sub, graphics) are not needed and changing them never reruns the analysis.
+# With permutations > 0, the Z-test and KS algorithms estimate empirical p-values from that many permutations.
+# With db_key ALL_DATABASES the dataset is parsed once and analysed against every database (see multidb.userInput).
+# The wall time and peak memory of each stage (loading, parsing, matching, statistics, serialisation) are logged,
+# added to the stage statistics of the algorithm and database, and returned as a fourth result element.
 @celery.task(name='tasks.run.runAlg')
-def runAlg(script, ks_db, graphics, df, min_sub):
-    mod = importlib.import_module(script)
-    return mod.userInput(ks_db, graphics, df, min_sub)
+def runAlg(script, db_key, data_key, cache_key=None, permutations=0):
+    with recording(appconfig.PROFILE_MEMORY) as recorder:
+        blob = redis_client.get(data_key)
+        if blob is None:
+            raise ValueError("The uploaded dataset has expired.")
+        # A dataset shared by several jobs of a batch is removed by the last of them.
+        if redis_client.decr(data_key + ":jobs") <= 0:
+            redis_client.delete(data_key, data_key + ":jobs")
+        df = unpackDataset(blob)
+        profiling.mark("load")
+        if db_key == ALL_DATABASES:
+            result = multidb.userInput(db_map, script, df, permutations)
+        else:
+            result = importlib.import_module(script).userInput(db_map[db_key], "no", df, None, permutations)
+    metadata = {"algorithm": script, "database": db_key, "stages": recorder.stages}
+    # Further result tables are stored as artifacts with the scores and links (see putArtifacts).
+    if len(result) > 3:
+        metadata["tables"] = result[3]
+    result = list(result[:3]) + [metadata]
+    recordStages(redis_client, script, db_key, recorder.stages)
+    logger.info(script + " on " + db_key + ": " + formatStages(recorder.stages))
+    if cache_key is not None:
+        putResult(redis_client, cache_key, result, appconfig.RESULT_CACHE_SIZE, appconfig.RESULT_CACHE_TTL)
+    return result
+
+# Create a celery task that renders the plot of finished results from their stored kinase scores.
+# The figure is stored with the results under its plot parameters, so replotting never recomputes statistics.
+# Its stages (reading the scores, rendering and storing the figure) are recorded like those of runAlg.
+@celery.task(name='tasks.run.renderPlot')
+def renderPlot(taskid, min_sub, size, fmt):
+    with recording(appconfig.PROFILE_MEMORY) as recorder:
+        script = getArtifact(redis_client, taskid, "script")
+        scores = getArtifact(redis_client, taskid, "scores")
+        if script not in single_list + multi_list or scores is None:
+            raise ValueError("The results have expired.")
+        mod = importlib.import_module(script)
+        scores_df = pd.read_json(scores, orient='split')
+        profiling.mark("read_scores")
+        name = plotName(min_sub, size, fmt)
+        if script in multi_list:
+            figure = mod.plotScores(scores_df, min_sub, size, fmt)
+            # The layout of raster heatmaps is stored with the figure, so that the browser can look up cell values on hover.
+            heatmap_df = heatmapFrame(scores_df, mod.HEATMAP_STAT, min_sub)
+            if heatmap_df.size > RASTER_CELLS:
+                putArtifact(redis_client, taskid, "cells:" + name, json.dumps(rasterLayout(*heatmap_df.shape, size)), appconfig.ARTIFACT_MAX_SIZE)
+        else:
+            figure = mod.plotScores(scores_df, min_sub, size, fmt)
+        profiling.mark("render")
+        putArtifact(redis_client, taskid, name, figure, appconfig.ARTIFACT_MAX_SIZE, appconfig.ARTIFACT_COMPRESSION)
+        profiling.mark("store_plot")
+    # Plot stages are counted with the database of the analysis, if it is known.
+    db_key = getArtifact(redis_client, taskid, "database") or "unknown"
+    recordStages(redis_client, script, db_key, recorder.stages)
+    logger.info(script + " plot " + name + ": " + formatStages(recorder.stages))
 
 # Attempts to free memory after each task.
 @task_postrun.connect 
@@ -81,18 +161,55 @@ def gc_after_task(**kwargs):
     import gc
     gc.collect() 
 
-# Upload the PhosphoSitePlus database.
-psp_db = uploadPSP()
-# Upload the PDTS database.
-pdts_db = uploadPDTS()
-# Upload the EDGES database.
-edges_db = uploadEDGES()
+# Metric labels of a task: its name and, where known, the algorithm and database it runs.
+def task_labels(task, args):
+    name = task.name.rsplit(".", 1)[-1]
+    if name == "runAlg":
+        return {"task": name, "algorithm": args[0], "database": args[1]}
+    if name == "renderPlot":
+        return {"task": name, "algorithm": getArtifact(redis_client, args[0], "script") or "", "database": getArtifact(redis_client, args[0], "database") or ""}
+    return {"task": name, "algorithm": "", "database": ""}
+
+# Task wait and run times are recorded for /metrics: the time a task is sent, started and finished.
+# Start times are kept per worker process, which runs the task from start to finish.
+task_starts = {}
+
+@before_task_publish.connect
+def metrics_task_sent(headers=None, **kwargs):
+    if headers and "id" in headers:
+        metrics.taskSent(redis_client, headers["id"])
 
-# A dictionary mapping the database name to the array storing the database entries.
-# Used for the conditional loop on the 'upload' page.
-db_map = {"psp": psp_db, "pdts": pdts_db, "edges": edges_db}
+@task_prerun.connect
+def metrics_task_started(task_id=None, task=None, args=None, **kwargs):
+    wait = metrics.taskStarted(redis_client, task_id)
+    labels = task_labels(task, args)
+    if wait is not None:
+        metrics.observe(redis_client, "ksea_task_wait_seconds", labels, wait)
+    redis_client.incr(metrics.METRICS_PREFIX + "running")
+    task_starts[task_id] = (time.perf_counter(), labels)
+
+@task_postrun.connect
+def metrics_task_finished(task_id=None, state=None, **kwargs):
+    redis_client.decr(metrics.METRICS_PREFIX + "running")
+    redis_client.set(metrics.METRICS_PREFIX + "last-finished", time.time())
+    if task_id not in task_starts:
+        return
+    start, labels = task_starts.pop(task_id)
+    metrics.observe(redis_client, "ksea_task_run_seconds", labels, time.perf_counter() - start)
+    metrics.increment(redis_client, "ksea_tasks_total", dict(labels, state=state or ""))
+
+# A dictionary mapping the database name to its site-keyed index, built once at load time.
+# Compiled database artifacts are used when up to date, otherwise the .tsv files are parsed.
+# Used to validate the database choice on the 'upload' page and to resolve the database key inside tasks.
+db_map = {"psp": loadDatabase("psp"), "pdts": loadDatabase("pdts"), "edges": loadDatabase("edges")}
+# Checksum of each database file, used as the database version in result cache keys (computed once, when the database was loaded).
+db_versions = {"psp": sourceChecksum("psp"), "pdts": sourceChecksum("pdts"), "edges": sourceChecksum("edges")}
+# Analyses against all databases (ALL_DATABASES) depend on the versions of all of them.
+db_versions[ALL_DATABASES] = ",".join(db_versions[db_key] for db_key in db_map)
+# Number of threads each analysis uses for the samples of multi-sample datasets.
+engine.COLUMN_WORKERS = appconfig.COLUMN_WORKERS
 single_list = ["ztest_single", "karp_single", "ks_single"]
-multi_list = ["ztest_multi", "karp_multi", "ks_multi"]
+multi_list = ["ztest_multi", "karp_multi", "ks_multi", "all_multi"]
 
 # Function that checks if a file extension is valid. Must return the boolean 'true' to proceed.
 def allowed_file(filename):
@@ -100,12 +217,12 @@ def allowed_file(filename):
 
 # Selection form for available databases is defined.
 class DbForm(FlaskForm):
-    choices = [("psp", "PhosphoSitePlus"), ("pdts", "PDTS"), ("edges", "EDGES")]
+    choices = [("psp", "PhosphoSitePlus"), ("pdts", "PDTS"), ("edges", "EDGES"), (ALL_DATABASES, "All databases (side-by-side comparison)")]
     select_db = SelectField(choices=choices)
     
 # Selection form for all KSEA algorithms is defined here.
 class AlgForm(FlaskForm):
-    choices = [("ks_single", "Kolmogorov-Smirnov (Single Sample)"), ("ks_multi", "Kolmogorov-Smirnov (Multiple Samples)"), ("karp_single", "KARP (Single Sample)"), ("karp_multi", "KARP (Multiple Samples)"), ("ztest_single", "Z-test (Single Sample)"), ("ztest_multi", "Z-test (Multiple Samples)")]
+    choices = [("ks_single", "Kolmogorov-Smirnov (Single Sample)"), ("ks_multi", "Kolmogorov-Smirnov (Multiple Samples)"), ("karp_single", "KARP (Single Sample)"), ("karp_multi", "KARP (Multiple Samples)"), ("ztest_single", "Z-test (Single Sample)"), ("ztest_multi", "Z-test (Multiple Samples)"), ("all_multi", "All algorithms (Z-test, KS and, for intensities, KARP)")]
     select_alg = SelectField(choices=choices)
     
 # Selection form for whether or not to plot a graph.
@@ -113,6 +230,11 @@ class GraphicsForm(FlaskForm):
     choices = [("no", "No"), ("yes", "Yes")]
     select_graphics = SelectField(choices=choices)
 
+# Selection form for how p-values of the Z-test and KS algorithms are computed: analytically or from permutations.
+class PValueForm(FlaskForm):
+    choices = [("0", "Analytical"), ("1000", "Empirical (1,000 permutations)"), ("10000", "Empirical (10,000 permutations)")]
+    select_permutations = SelectField(choices=choices)
+
 # Plot parameters: minimum number of substrates per kinase.
 class SubForm(FlaskForm):
     sub_choice = IntegerField("substrate_count", default=5)
@@ -130,6 +252,7 @@ def upload():
     alg_form = AlgForm()
     sub_form = SubForm()
     plot_form = GraphicsForm()
+    pvalue_form = PValueForm()
     select_db = None
     select_alg = None
     sub_choice = None
@@ -143,26 +266,48 @@ def upload():
             session.permanent = True
             session.regenerate()
             f = file.read()
-            stream = BytesIO()
-            stream.write(f)
-            stream.seek(0)
-            df = pd.read_csv(stream, sep="\t")
-            df=df.to_json(orient="split")
-            stream.close()
             select_db = db_form.select_db.data
             select_alg = alg_form.select_alg.data
             min_sub = sub_form.sub_choice.data
             graphics = plot_form.select_graphics.data
+            permutations = int(pvalue_form.select_permutations.data or 0)
             alg_type = select_alg.split("_")[1]
+            if select_db not in db_versions or select_alg not in single_list + multi_list or not 0 <= permutations <= appconfig.MAX_PERMUTATIONS:
+                flash('Please select a valid database and algorithm.')
+                return redirect(url_for('upload'))
+            if select_db == ALL_DATABASES and select_alg == "all_multi":
+                flash('All algorithms can only be run against one database at a time.')
+                return redirect(url_for('upload'))
+            # A comparison of all databases has multi-sample results, in which every (sample, database) pair is a column.
+            select_alg = multidb.jobScript(select_alg, select_db)
+            if select_db == ALL_DATABASES:
+                alg_type = "multi"
+            # Identical submissions (same file, database version, algorithm and permutations) are served from the result cache,
+            # whatever their plot parameters. A cached result is stored under a new task id, so the results page fetches it
+            # as if the task had just finished, and draws its plot for the new parameters.
+            cache_key = resultKey(f, select_db, db_versions[select_db], select_alg, permutations)
+            cached = getResult(redis_client, cache_key)
+            if cached is not None:
+                taskid = str(uuid.uuid4())
+                celery.backend.store_result(taskid, cached, states.SUCCESS)
+                return redirect(url_for('show_results', alg_type=alg_type, taskid=taskid, script=select_alg, graphics=graphics, min_sub=min_sub, database=select_db))
+            stream = BytesIO()
+            stream.write(f)
+            stream.seek(0)
+            df = pd.read_csv(stream, sep="\t")
+            stream.close()
+            # The parsed dataset is stored once as a compact binary blob under a job key.
+            # Only the key travels through the Celery broker.
+            data_key = "dataset:" + uuid.uuid4().hex
+            redis_client.set(data_key, packDataset(df), ex=appconfig.DATASET_LIFETIME)
             if alg_type == "single":
                 alg_list = single_list
                 for x in alg_list:
                     if select_alg == x:
                         script = x
-                        ks_db = db_map[select_db]
-                        res = runAlg.delay(script, ks_db, graphics, df, min_sub)
+                        res = runAlg.delay(script, select_db, data_key, cache_key, permutations)
                         taskid = res.task_id
-                        return redirect(url_for('show_results', alg_type=alg_type, taskid=taskid))
+                        return redirect(url_for('show_results', alg_type=alg_type, taskid=taskid, script=script, graphics=graphics, min_sub=min_sub, database=select_db))
                     else:
                         continue
             elif alg_type == "multi":
@@ -170,13 +315,12 @@ def upload():
                 for x in alg_list:
                     if select_alg == x:
                         script = x
-                        ks_db = db_map[select_db]
-                        res = runAlg.delay(script, ks_db, graphics, df, min_sub)
+                        res = runAlg.delay(script, select_db, data_key, cache_key, permutations)
                         taskid = res.task_id
-                        return redirect(url_for('show_results', alg_type=alg_type, taskid=taskid))
+                        return redirect(url_for('show_results', alg_type=alg_type, taskid=taskid, script=script, graphics=graphics, min_sub=min_sub, database=select_db))
                     else:
                         continue
-    return render_template("upload.html", title="Upload File", db_form=db_form, alg_form=alg_form, sub_form=sub_form, plot_form=plot_form)
+    return render_template("upload.html", title="Upload File", db_form=db_form, alg_form=alg_form, sub_form=sub_form, plot_form=plot_form, pvalue_form=pvalue_form)
 
 @app.route("/getting-started")   
 def getting_started():
@@ -194,7 +338,11 @@ def contact():
 def sitemap():
     return send_from_directory('static', filename='sitemap/sitemap.xml')
 
-# AJAX request sent every 10 seconds fetches task status and results (if ready) from this view.
+# AJAX request fetches task status and results (if ready) from this view.
+# With wait=1 the request is held open until the task finishes, for up to RESULT_WAIT_TIMEOUT seconds (long polling).
+# Celery's Redis result backend notifies the waiting request through pub/sub as soon as the result is stored,
+# so results are returned immediately and a job normally needs a single request.
+# A waiting request occupies a web worker thread, so the app is served by threaded gunicorn workers (see gunicorn.conf.py).
 @app.route("/test-results", methods=['GET', 'POST'])
 def get_results():
     tries = 3
@@ -203,26 +351,13 @@ def get_results():
             alg = request.args.get('alg')
             taskid = request.args.get('taskid')
             r = celery.AsyncResult(taskid)
-            if r.ready() == True and alg == 'single':
+            # Only the first attempt waits, so that retries cannot hold the request beyond the request timeout.
+            if attempt == 0 and request.args.get('wait') == '1' and r.ready() == False:
                 try:
-                    session.regenerate()
-                    result = r.result
-                    r.forget()
-                    scores = result[0]
-                    links = result[1]
-                    plot = result[2]
-                    session["scores"] = scores
-                    session["links"] = links
-                    session["plot"] = plot
-                    sdf = pd.read_json(scores, orient='split')
-                    ldf = pd.read_json(links, orient='split')
-                    score_tab=sdf.to_html(index=False, classes = 'row-border hover stripe" id = "resTable').replace('border="1"','border="0"')
-                    links_tab = ldf.to_html(index=False, classes = 'row-border hover stripe" id = "linkTable').replace('border="1"','border="0"')
-                    return jsonify({'plot':plot, 'scores':score_tab, 'links':links_tab, 'status': 'complete'})
-                except(ValueError, TypeError):
-                    r.forget()
-                    return jsonify({'err':'An error has occured. Please check your dataset and plot parameters.', 'status': 'error'})
-            elif r.ready() == True and alg == 'multi':
+                    r.get(timeout=appconfig.RESULT_WAIT_TIMEOUT, propagate=False)
+                except CeleryTimeoutError:
+                    pass
+            if r.ready() == True and alg in ['single', 'multi']:
                 try:
                     session.regenerate()
                     result = r.result
@@ -230,10 +365,16 @@ def get_results():
                     scores = result[0]
                     links = result[1]
                     plot = result[2]
-                    session["scores"] = scores
-                    session["links"] = links
-                    session["plot"] = plot
-                    return jsonify({'plot':plot, 'scores': 'Kinase activity data available only as a downloadable .csv file.', 'links': 'K-S relationship data available only as a downloadable .csv file.', 'status': 'complete'})
+                    # The algorithm is read from the task's metadata rather than from the request.
+                    script = result[3]["algorithm"] if len(result) > 3 else None
+                    size = putArtifacts(redis_client, taskid, result, appconfig.ARTIFACT_LIFETIME, appconfig.ARTIFACT_MAX_SIZE, appconfig.ARTIFACT_COMPRESSION)
+                    metrics.observe(redis_client, "ksea_result_bytes", {"algorithm": script or "", "database": result[3]["database"] if len(result) > 3 else ""}, size)
+                    if script in single_list + multi_list:
+                        putArtifact(redis_client, taskid, "script", script, appconfig.ARTIFACT_MAX_SIZE)
+                    if len(result) > 3:
+                        putArtifact(redis_client, taskid, "database", result[3]["database"], appconfig.ARTIFACT_MAX_SIZE)
+                    session["result"] = taskid
+                    return jsonify({'plot':plot, 'scores':tableColumns(scores), 'links':tableColumns(links), 'status': 'complete'})
                 except(ValueError, TypeError):
                     r.forget()
                     return jsonify({'err':'An error has occured. Please check your dataset and plot parameters.', 'status': 'error'})
@@ -245,63 +386,301 @@ def get_results():
             else:
                 raise
 
+# Results tables are paged, searched and sorted on the server (DataTables server-side processing).
+# Only the rows shown are sent to the browser, so large single- and multi-sample results can be browsed.
+# The whole stored table is still parsed for every page.
+@app.route("/results-table/<table>")
+def results_table(table):
+    data = getArtifact(redis_client, session.get("result"), table) if table in ["scores", "links"] else None
+    if data is None:
+        abort(404)
+    df = pd.read_json(data, orient='split')
+    try:
+        page = tablePage(df, request.args)
+    except ValueError as e:
+        return jsonify({'err':str(e), 'status': 'error'}), 400
+    return jsonify(page)
+
+# Result cache hit/miss counters and size, used to tune RESULT_CACHE_SIZE and RESULT_CACHE_TTL.
+@app.route("/cache-stats")
+def cache_stats():
+    requireAdmin()
+    stats = cacheStats(redis_client)
+    stats["max_entries"] = appconfig.RESULT_CACHE_SIZE
+    stats["ttl_seconds"] = int(appconfig.RESULT_CACHE_TTL.total_seconds())
+    return jsonify(stats)
+
+# Operational endpoints need appconfig.ADMIN_TOKEN, sent as a bearer token (Authorization: Bearer <token>) or as the token argument.
+# They answer 404 while no token is configured, and 401 to requests without the right token.
+def requireAdmin():
+    if not appconfig.ADMIN_TOKEN:
+        abort(404)
+    header = request.headers.get("Authorization", "")
+    token = header[len("Bearer "):] if header.startswith("Bearer ") else request.args.get("token", "")
+    if not hmac.compare_digest(token.encode("utf-8"), appconfig.ADMIN_TOKEN.encode("utf-8")):
+        abort(401)
+
+# Stage timings and peak memory of all analyses and plots, aggregated by algorithm and database.
+# Shows which stage dominates for each algorithm, e.g. to decide what to optimise next.
+@app.route("/admin/stage-stats")
+def stage_stats():
+    requireAdmin()
+    return jsonify(stageStats(redis_client))
+
+# Operational metrics in the Prometheus text format: queue length and age of the oldest queued task, task wait and run times
+# per algorithm and database, stored result sizes, session store size and Redis round-trip latency.
+# The queue is read from the broker's Redis list, which is the same Redis instance as the result store (REDIS_URL).
+# An oldest queued task approaching the session lifetime means users will see their sessions expire before their results arrive.
+@app.route("/metrics")
+def get_metrics():
+    requireAdmin()
+    start = time.perf_counter()
+    redis_client.ping()
+    ping = time.perf_counter() - start
+    sessions, session_bytes = metrics.sessionSizes(redis_client)
+    gauges = [
+        ("ksea_queue_length", "Tasks waiting in the Celery queue.", redis_client.llen(celery.conf.task_default_queue)),
+        ("ksea_queue_oldest_wait_seconds", "Time the oldest queued task has been waiting.", metrics.oldestQueued(redis_client)),
+        ("ksea_tasks_running", "Tasks being run by workers.", int(redis_client.get(metrics.METRICS_PREFIX + "running") or 0)),
+        ("ksea_last_task_finished_timestamp_seconds", "Unix time at which a worker last finished a task.", float(redis_client.get(metrics.METRICS_PREFIX + "last-finished") or 0)),
+        ("ksea_session_lifetime_seconds", "Lifetime of user sessions.", appconfig.PERMANENT_SESSION_LIFETIME.total_seconds()),
+        ("ksea_sessions", "User sessions in the session store.", sessions),
+        ("ksea_session_bytes", "Total size of the user sessions in the session store.", session_bytes),
+        ("ksea_redis_ping_seconds", "Round-trip time of a Redis PING from the web app.", ping),
+    ]
+    return Response(metrics.exposition(redis_client, gauges), mimetype="text/plain; version=0.0.4")
+
 @app.route("/ksea/<alg_type>/<taskid>", methods=['GET', 'POST'])
 def show_results(alg_type, taskid):
     uid = taskid
     placeholder=''
-    return render_template('test.html', placeholder=placeholder, alg_type=alg_type, taskid=taskid, title="KSEA Results", uid=uid)
+    script = request.args.get('script', '')
+    graphics = request.args.get('graphics', 'no')
+    min_sub = request.args.get('min_sub', 5, type=int)
+    compare = request.args.get('database') == ALL_DATABASES
+    return render_template('test.html', placeholder=placeholder, alg_type=alg_type, taskid=taskid, title="KSEA Results", uid=uid, binary_formats=binaryFormats(), script=script, graphics=graphics, min_sub=min_sub, plot_formats=PLOT_FORMATS, compare=compare)
+
+# Plot parameters are read from the request: minimum substrate count, size factor and format.
+def plot_params(args):
+    min_sub = args.get('min_sub', 5, type=int)
+    size = round(min(max(args.get('size', 1.0, type=float), MIN_PLOT_SIZE), MAX_PLOT_SIZE), 2)
+    fmt = args.get('format', 'svg')
+    if fmt not in PLOT_FORMATS:
+        fmt = 'svg'
+    return min_sub, size, fmt
+
+# Plots are rendered lazily: the first request for a parameter set starts a renderPlot task, later requests are served from the store.
+# Concurrent requests for the same parameter set share one task, whose id is kept under a short-lived Redis key.
+# As with results, wait=1 holds the request open until the plot is ready, for up to RESULT_WAIT_TIMEOUT seconds.
+@app.route("/plot")
+def get_plot():
+    taskid = session.get("result")
+    min_sub, size, fmt = plot_params(request.args)
+    name = plotName(min_sub, size, fmt)
+    figure = getArtifact(redis_client, taskid, name, binary=True)
+    if figure is None:
+        if getArtifact(redis_client, taskid, "script") is None:
+            return jsonify({'err':'Your results have expired. Please run the analysis again.', 'status': 'error'})
+        render_key = "plot-task:" + taskid + ":" + name
+        render_id = str(uuid.uuid4())
+        if redis_client.set(render_key, render_id, nx=True, ex=appconfig.ARTIFACT_LIFETIME):
+            renderPlot.apply_async((taskid, min_sub, size, fmt), task_id=render_id)
+        else:
+            render_id = redis_client.get(render_key).decode("utf-8")
+        r = celery.AsyncResult(render_id)
+        if request.args.get('wait') == '1' and r.ready() == False:
+            try:
+                r.get(timeout=appconfig.RESULT_WAIT_TIMEOUT, propagate=False)
+            except CeleryTimeoutError:
+                pass
+        if r.failed():
+            r.forget()
+            redis_client.delete(render_key)
+            return jsonify({'err':'The plot could not be generated. Please check your plot parameters.', 'status': 'error'})
+        figure = getArtifact(redis_client, taskid, name, binary=True)
+        if figure is None:
+            return jsonify({'status':'pending'})
+    if fmt == "png":
+        figure = '<img src="data:image/png;base64,' + base64.b64encode(figure).decode("ascii") + '">'
+    else:
+        figure = figure.decode("utf-8")
+    cells = getArtifact(redis_client, taskid, "cells:" + name)
+    return jsonify({'plot':figure, 'cells': json.loads(cells) if cells else None, 'status': 'complete'})
+
+# Values of one cell of a raster heatmap (row and column as drawn for the given min_sub), read from the stored results.
+# Returns the kinase, its substrate count and all per-sample statistics of that kinase in that sample.
+@app.route("/heatmap-cell")
+def heatmap_cell():
+    taskid = session.get("result")
+    script = getArtifact(redis_client, taskid, "script")
+    scores = getArtifact(redis_client, taskid, "scores")
+    if script not in multi_list or scores is None:
+        abort(404)
+    mod = importlib.import_module(script)
+    scores_df = pd.read_json(scores, orient='split')
+    heatmap_df = heatmapFrame(scores_df, mod.HEATMAP_STAT, request.args.get('min_sub', 5, type=int))
+    row = request.args.get('row', -1, type=int)
+    col = request.args.get('col', -1, type=int)
+    if not (0 <= row < heatmap_df.shape[0] and 0 <= col < heatmap_df.shape[1]):
+        abort(404)
+    sample = heatmap_df.columns[col]
+    record = scores_df[scores_df["Kinase"] == heatmap_df.index[row]].iloc[0]
+    cell = {"Kinase": record["Kinase"], "Sample": sample, "Sub.Count": int(record["Sub.Count"])}
+    for stat in mod.SAMPLE_STATS:
+        cell[stat + sample] = None if pd.isna(record[stat + sample]) else float(record[stat + sample])
+    return jsonify(cell)
 
 # send_file requires BytesIO.
-# Here SVG data is encoded to bytes and written into the buffer.
+# The rendered plot for the requested plot parameters is read from the store and written into the buffer.
 @app.route("/download/fig/<uid>")
 def fig_download(uid):
-    try:
-        graph = session.get("plot")
-        buffer = BytesIO()
-        buffer.write(graph.encode('utf-8'))
-        buffer.seek(0)
-        return send_file(buffer, mimetype='image/svg+xml', attachment_filename="plot-"+uid+".svg", as_attachment=True)
-    except AttributeError:
+    min_sub, size, fmt = plot_params(request.args)
+    graph = getArtifact(redis_client, session.get("result"), plotName(min_sub, size, fmt), binary=True)
+    if graph is None:
+        return render_template("timeout.html", title="Session expired")
+    buffer = BytesIO(graph)
+    mimetype = 'image/png' if fmt == 'png' else 'image/svg+xml'
+    return send_file(buffer, mimetype=mimetype, attachment_filename="plot-"+uid+"."+fmt, as_attachment=True)
+
+# Results tables are downloaded as CSV (default) or TSV, optionally gzip-compressed (gzip=1), or as Parquet or Feather files.
+# The stored table is parsed in full into a dataframe, and text formats are then streamed to the client in chunks of rows,
+# so that the encoded file is not also built in memory as a whole.
+def table_download(taskid, table, filename):
+    data = getArtifact(redis_client, taskid, table)
+    if data is None:
         return render_template("timeout.html", title="Session expired")
+    fmt = request.args.get("format", "csv")
+    if fmt not in FORMATS or (fmt in ["parquet", "feather"] and fmt not in binaryFormats()):
+        abort(404)
+    df = pd.read_json(data, orient='split')
+    del data
+    extension, mimetype, streamed = FORMATS[fmt]
+    if not streamed:
+        return send_file(BytesIO(binaryTable(df, fmt)), mimetype=mimetype, attachment_filename=filename+extension, as_attachment=True)
+    chunks = textChunks(df, "\t" if fmt == "tsv" else ",")
+    if request.args.get("gzip") == "1":
+        chunks = gzipChunks(chunks)
+        extension, mimetype = extension + ".gz", "application/gzip"
+    return Response(chunks, mimetype=mimetype, headers={"Content-Disposition": "attachment; filename=" + filename + extension})
 
-# Here kinase-score json string is converted back into a dataframe and then written into a proxy string buffer as a csv file. It is then encoded to downloadable bytes data.
 @app.route("/download/scores/<uid>")
 def download_scores(uid):
-    try:
-        scores = session.get("scores")
-        scores = pd.read_json(scores, orient='split')
-        proxy = StringIO()
-        scores.to_csv(proxy, index=False)
-        proxy.seek(0)
-        data=proxy.getvalue()
-        proxy.close()
-        byte_data=data.encode('utf-8')
-        buffer = BytesIO()
-        buffer.write(byte_data)
-        buffer.seek(0)
-        return send_file(buffer, mimetype='text/csv', attachment_filename="ksea_scores-"+uid+".csv", as_attachment=True)
-    except ValueError:
-        return render_template("timeout.html", title="Session expired")
-    
-# Here, Kinase-Substrate-Relationships data is manipulated as above in order to be downloadable.
+    return table_download(session.get("result"), "scores", "ksea_scores-"+uid)
+
 @app.route("/download/links/<uid>")
 def download_links(uid):
+    return table_download(session.get("result"), "links", "ks-links-"+uid)
+
+# Kinase scores of every database of a comparison of all databases, with a database column.
+@app.route("/download/database-scores/<uid>")
+def download_database_scores(uid):
+    return table_download(session.get("result"), DATABASE_SCORES, "ksea_database_scores-"+uid)
+
+# Batch API for pipelines: many datasets, each analysed with several (algorithm, database, permutations) combinations, in one request.
+# The request body is JSON as described in batches.batchJobs. Identical jobs are run once, and jobs already in the result cache are not run.
+# The remaining jobs are enqueued as one Celery group. The response holds the batch id and the status URL.
+@app.route("/api/batch", methods=['POST'])
+def submit_batch():
+    if request.content_length is None or request.content_length > appconfig.BATCH_MAX_SIZE:
+        return jsonify({'err':'Batches must be smaller than ' + str(appconfig.BATCH_MAX_SIZE) + ' bytes.', 'status': 'error'}), 413
     try:
-        links = session.get("links")
-        links = pd.read_json(links, orient='split')
-        proxy = StringIO()
-        links.to_csv(proxy, index=False)
-        proxy.seek(0)
-        data = proxy.getvalue()
-        proxy.close()
-        byte_data = data.encode('utf-8')
-        buffer = BytesIO()
-        buffer.write(byte_data)
-        buffer.seek(0)
-        return send_file(buffer, mimetype='text/csv', attachment_filename="ks-links-"+uid+".csv", as_attachment=True)
-    except ValueError:
-        return render_template("timeout.html", title="Session expired")
-    
+        datasets, jobs = batchJobs(request.get_json(silent=True), single_list + multi_list, db_versions, appconfig.BATCH_MAX_JOBS, appconfig.MAX_PERMUTATIONS)
+    except ValueError as e:
+        return jsonify({'err':str(e), 'status': 'error'}), 400
+    if any(job["database"] == ALL_DATABASES and job["algorithm"] == "all_multi" for job in jobs):
+        return jsonify({'err':'All algorithms can only be run against one database at a time.', 'status': 'error'}), 400
+    # As with uploads, comparisons of all databases run the multi-sample implementation of single-sample algorithms.
+    for job in jobs:
+        job["algorithm"] = multidb.jobScript(job["algorithm"], job["database"])
+    keys = [resultKey(datasets[job["dataset"]], job["database"], db_versions[job["database"]], job["algorithm"], job["permutations"]) for job in jobs]
+    merged = mergeJobs(jobs, keys)
+    # Every dataset is parsed before anything is written to Redis, so that an invalid dataset leaves nothing behind.
+    frames = {}
+    for name in datasets:
+        try:
+            frames[name] = pd.read_csv(BytesIO(datasets[name]), sep="\t")
+        except Exception:
+            return jsonify({'err':'Dataset ' + name + ' is not a valid .tsv file.', 'status': 'error'}), 400
+    # Each dataset is stored once, and read by all of its jobs that are not served from the cache.
+    data_keys = {}
+    signatures = []
+    for key, job in merged.items():
+        job["task_id"] = str(uuid.uuid4())
+        cached = getResult(redis_client, key)
+        if cached is not None:
+            celery.backend.store_result(job["task_id"], cached, states.SUCCESS)
+            continue
+        name = job["datasets"][0]
+        if name not in data_keys:
+            data_keys[name] = "dataset:" + uuid.uuid4().hex
+            redis_client.set(data_keys[name], packDataset(frames[name]), ex=appconfig.DATASET_LIFETIME)
+            redis_client.set(data_keys[name] + ":jobs", 0, ex=appconfig.DATASET_LIFETIME)
+        redis_client.incr(data_keys[name] + ":jobs")
+        signatures.append(runAlg.signature((job["algorithm"], job["database"], data_keys[name], key, job["permutations"]), task_id=job["task_id"]))
+    if signatures:
+        group(signatures).apply_async()
+    batch_id = str(uuid.uuid4())
+    jobs = list(merged.values())
+    putBatch(redis_client, batch_id, jobs, appconfig.BATCH_LIFETIME)
+    return jsonify({'batch_id': batch_id, 'jobs': len(jobs), 'status_url': url_for('batch_status', batch_id=batch_id, _external=True), 'status': 'submitted'}), 202
+
+# Status of every job of a batch. Finished results are moved to the artifact store, where they are kept for BATCH_LIFETIME,
+# and each finished job lists the download URLs of its kinase scores and kinase-substrate links (see table_download for formats).
+@app.route("/api/batch/<batch_id>")
+def batch_status(batch_id):
+    jobs, stored, errors = getBatch(redis_client, batch_id)
+    if jobs is None:
+        return jsonify({'err':'Unknown or expired batch.', 'status': 'error'}), 404
+    counts = {}
+    for job in jobs:
+        taskid = job["task_id"]
+        job.pop("err", None)
+        if taskid in errors:
+            job["err"] = errors[taskid]
+        elif taskid not in stored:
+            r = celery.AsyncResult(taskid)
+            if r.successful():
+                try:
+                    result = r.result
+                    putArtifacts(redis_client, taskid, result, appconfig.BATCH_LIFETIME, appconfig.ARTIFACT_MAX_SIZE, appconfig.ARTIFACT_COMPRESSION)
+                    putArtifact(redis_client, taskid, "script", job["algorithm"], appconfig.ARTIFACT_MAX_SIZE)
+                    putArtifact(redis_client, taskid, "database", job["database"], appconfig.ARTIFACT_MAX_SIZE)
+                    markStored(redis_client, batch_id, taskid)
+                    stored.add(taskid)
+                except (ValueError, TypeError) as e:
+                    # The error is kept with the batch, as the task result is forgotten below.
+                    job["err"] = str(e)
+                    markStored(redis_client, batch_id, taskid, error=job["err"])
+                r.forget()
+            elif r.failed():
+                job["err"] = str(r.result)
+        if "err" in job:
+            job["status"] = "error"
+        elif taskid in stored:
+            if getArtifact(redis_client, taskid, "script") is None:
+                job["status"] = "expired"
+            else:
+                job["status"] = "complete"
+                job["scores_url"] = url_for('api_download', taskid=taskid, table='scores', _external=True)
+                job["links_url"] = url_for('api_download', taskid=taskid, table='links', _external=True)
+                if job["database"] == ALL_DATABASES:
+                    job["database_scores_url"] = url_for('api_download', taskid=taskid, table=DATABASE_SCORES, _external=True)
+        else:
+            job["status"] = celery.AsyncResult(taskid).state.lower()
+        counts[job["status"]] = counts.get(job["status"], 0) + 1
+    done = counts.get("complete", 0) + counts.get("error", 0) + counts.get("expired", 0)
+    return jsonify({'batch_id': batch_id, 'jobs': jobs, 'counts': counts, 'status': 'complete' if done == len(jobs) else 'pending'})
+
+# Results tables of a batch job, addressed by task id instead of the session. Takes the same format and gzip arguments as the result page downloads.
+@app.route("/api/results/<taskid>/<table>")
+def api_download(taskid, table):
+    filenames = {"scores": "ksea_scores-", "links": "ks-links-", DATABASE_SCORES: "ksea_database_scores-"}
+    if table not in filenames:
+        abort(404)
+    if getArtifact(redis_client, taskid, "script") is None:
+        abort(404)
+    return table_download(taskid, table, filenames[table] + taskid)
+
 # Run in production
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,124 @@
+import argparse
+import glob
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from io import StringIO
+
+import pandas as pd
+
+import engine
+from databases import loadDatabase
+from datasets import packDataset, unpackDataset
+from figures import PLOT_FORMATS
+
+# Headless KSEA runner for local .tsv files, without Redis, Celery or the web server.
+# Every input file is analysed with every chosen algorithm and database. Jobs are spread across a pool of worker processes,
+# each of which loads the databases once. Kinase scores, kinase-substrate links and (optionally) plots are written to the output directory
+# as <file name>.<algorithm>.<database>.scores.csv, .links.csv and .plot.svg (or .png). A summary of all jobs is written to summary.json.
+#
+# Example:
+#   python runner.py data/ --algorithms ks_multi,ztest_multi --databases psp,pdts --plots svg --output results/ --processes 8
+
+ALGORITHMS = ["ztest_single", "karp_single", "ks_single", "ztest_multi", "karp_multi", "ks_multi", "all_multi"]
+DATABASES = ["psp", "pdts", "edges"]
+TABLE_FORMATS = {"csv": ",", "tsv": "\t"}
+
+# Databases of the current worker process, loaded once by the pool initializer.
+worker_dbs = {}
+
+def initWorker(db_keys, column_workers):
+    for db_key in db_keys:
+        worker_dbs[db_key] = loadDatabase(db_key)
+    engine.COLUMN_WORKERS = column_workers
+
+# Input paths are expanded into .tsv files. Directories are searched (not recursively) for files ending in .tsv.
+def inputFiles(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "*.tsv"))))
+        else:
+            files.append(path)
+    return files
+
+# One file is analysed with one algorithm and database, and its results are written to the output directory.
+# The file is read like an upload: it is packed and unpacked as in the web app, so results are identical.
+# Errors are returned in the job summary, so that one bad file does not stop the run.
+def runJob(job):
+    path, alg, db_key, options = job
+    start = time.perf_counter()
+    summary = {"file": path, "algorithm": alg, "database": db_key}
+    try:
+        mod = importlib.import_module(alg)
+        df = unpackDataset(packDataset(pd.read_csv(path, sep="\t")))
+        scores, links, message = mod.userInput(worker_dbs[db_key], "no", df, options["min_sub"], options["permutations"])[:3]
+        prefix = os.path.join(options["output"], os.path.splitext(os.path.basename(path))[0] + "." + alg + "." + db_key)
+        sep = TABLE_FORMATS[options["format"]]
+        scores_df = pd.read_json(StringIO(scores), orient='split')
+        scores_df.to_csv(prefix + ".scores." + options["format"], sep=sep, index=False)
+        pd.read_json(StringIO(links), orient='split').to_csv(prefix + ".links." + options["format"], sep=sep, index=False)
+        if options["plots"] != "none":
+            figure = mod.plotScores(scores_df, options["min_sub"], options["size"], options["plots"])
+            with open(prefix + ".plot." + options["plots"], "wb") as plot_file:
+                plot_file.write(figure.encode("utf-8") if isinstance(figure, str) else figure)
+        summary["kinases"] = len(scores_df)
+    except Exception as e:
+        summary["error"] = type(e).__name__ + ": " + str(e)
+    summary["seconds"] = time.perf_counter() - start
+
+    return summary
+
+def parseList(value):
+    return [x for x in value.split(",") if x != ""]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run KSEA on local .tsv files.")
+    parser.add_argument("inputs", nargs="+", help=".tsv files or directories containing them")
+    parser.add_argument("--algorithms", default="ks_multi", help="comma-separated algorithms: " + ",".join(ALGORITHMS))
+    parser.add_argument("--databases", default="psp", help="comma-separated databases: " + ",".join(DATABASES))
+    parser.add_argument("--min-sub", type=int, default=5, help="minimum substrate count per kinase for plots")
+    parser.add_argument("--permutations", type=int, default=0, help="permutations for empirical p-values of the Z-test and KS algorithms (0 for analytical p-values)")
+    parser.add_argument("--plots", default="none", choices=["none"] + PLOT_FORMATS)
+    parser.add_argument("--size", type=float, default=1.0, help="plot size factor")
+    parser.add_argument("--format", default="csv", choices=sorted(TABLE_FORMATS), help="format of the results tables")
+    parser.add_argument("--output", default="results", help="output directory")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--column-workers", type=int, default=1, help="threads per process for the samples of multi-sample datasets")
+    args = parser.parse_args(argv)
+
+    algorithms = parseList(args.algorithms)
+    db_keys = parseList(args.databases)
+    unknown = [x for x in algorithms if x not in ALGORITHMS] + [x for x in db_keys if x not in DATABASES]
+    if unknown:
+        parser.error("unknown algorithm or database: " + ", ".join(unknown))
+    files = [os.path.abspath(path) for path in inputFiles(args.inputs)]
+    if not files:
+        parser.error("no .tsv files found")
+    output = os.path.abspath(args.output)
+    os.makedirs(output, exist_ok=True)
+    # Database files are found relative to the repository root, so the runner can be started from any directory.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    options = {"min_sub": args.min_sub, "permutations": args.permutations, "plots": args.plots, "size": args.size, "format": args.format, "output": output}
+    jobs = [(path, alg, db_key, options) for path in files for alg in algorithms for db_key in db_keys]
+    summaries = []
+    with multiprocessing.Pool(min(args.processes, len(jobs)), initializer=initWorker, initargs=(db_keys, args.column_workers)) as pool:
+        for summary in pool.imap_unordered(runJob, jobs):
+            summaries.append(summary)
+            status = summary.get("error", "%d kinases" % summary.get("kinases", 0))
+            print("[%d/%d] %s %s %s: %s (%.2fs)" % (len(summaries), len(jobs), summary["file"], summary["algorithm"], summary["database"], status, summary["seconds"]), flush=True)
+
+    with open(os.path.join(output, "summary.json"), "w") as summary_file:
+        json.dump(summaries, summary_file, indent=1)
+    failed = sum(1 for summary in summaries if "error" in summary)
+    if failed:
+        print(str(failed) + " of " + str(len(jobs)) + " jobs failed.", file=sys.stderr)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,47 @@
+import json
+
+# One page of a results table is produced following the DataTables server-side processing protocol.
+# args holds the request parameters sent by DataTables: draw, start, length, search[value], order[0][column] and order[0][dir].
+# Rows are filtered by a case-insensitive search across all columns, sorted by the chosen column and then sliced.
+# A ValueError names the first parameter that is not an integer.
+def tablePage(df, args):
+    draw = intArg(args, "draw", 0)
+    start = max(intArg(args, "start", 0), 0)
+    length = intArg(args, "length", 10)
+    order_col = intArg(args, "order[0][column]", None)
+    search = args.get("search[value]", "")
+    total = len(df)
+
+    # Global search across all columns, as in client-side DataTables.
+    if search != "":
+        matched = None
+        for n in range(len(df.columns)):
+            found = df.iloc[:, n].astype(str).str.contains(search, case=False, regex=False)
+            matched = found if matched is None else matched | found
+        df = df[matched]
+
+    # Ordering by a single column. A stable sort keeps the original order of equal values.
+    if order_col is not None and 0 <= order_col < len(df.columns):
+        ascending = args.get("order[0][dir]", "asc") != "desc"
+        ordered = df.iloc[:, order_col].reset_index(drop=True).sort_values(ascending=ascending, kind="mergesort")
+        df = df.iloc[ordered.index]
+
+    # A length of -1 requests all rows.
+    page = df.iloc[start:] if length < 0 else df.iloc[start:start + length]
+
+    # Rows are serialised through pandas so that numpy values and missing values (null) are valid JSON.
+    return {"draw": draw, "recordsTotal": total, "recordsFiltered": len(df), "data": json.loads(page.to_json(orient="values"))}
+
+# An integer request parameter, or default if it is missing.
+def intArg(args, name, default):
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError("The " + name + " parameter must be an integer.")
+
+# Column names of a results table stored as a JSON string (orient="split"), read without building a dataframe.
+def tableColumns(table_json):
+    return json.loads(table_json)["columns"]
@@ -0,0 +1,21 @@
+from io import StringIO
+
+import pandas as pd
+
+import all_multi
+
+# PDPK1 is linked to every matched phosphosite, so KS has no non-substrate sites to compare against.
+KS_DB = {
+    "sites": {"AKT1_S473": [("PDPK1", "XXXXXXXSXXXXXXX", "PSP")], "GSK3B_S9": [("PDPK1", "XXXXXXXSXXXXXXX", "PSP")]},
+    "totals": {"PDPK1": 10},
+}
+
+# An algorithm that cannot score the dataset leaves its columns missing instead of failing the other algorithms.
+def test_failing_algorithm_does_not_fail_the_job():
+    df = pd.DataFrame({"Site": ["AKT1_S473", "GSK3B_S9", "MAPK1_T185"], "a": [1.5, 2.0, 0.3]})
+    scores, links, message = all_multi.userInput(KS_DB, "no", df, 1)
+    scores = pd.read_json(StringIO(scores), orient='split')
+    assert list(scores["Kinase"]) == ["PDPK1"]
+    assert scores[["zSc.a", "pVal.a.ztest", "kSc.a"]].notna().all().all()
+    assert scores[["(+/-)KS.a", "pVal.a.ks"]].isna().all().all()
+    assert "ks:" in message
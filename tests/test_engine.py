@@ -0,0 +1,98 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import scipy.stats as st
+
+import engine
+import karp_multi
+import ks_multi
+import ztest_multi
+
+# A small K-S db in the shape of databases.loadDatabase: phosphosites mapped to (kinase, site sequence, source) links.
+KS_DB = {
+    "sites": {
+        "AKT1_S473": [("PDPK1", "XXXXXXXSXXXXXXX", "PSP")],
+        "GSK3B_S9": [("AKT1", "XXXXXXXSXXXXXXX", "PSP"), ("PDPK1", "XXXXXXXSXXXXXXX", "PSP")],
+    },
+    "totals": {"PDPK1": 10, "AKT1": 20},
+}
+
+def test_interleave_orders_statistics_by_sample():
+    means = np.array([[1.0, 2.0], [3.0, 4.0]])
+    scores = means * 10
+    assert engine.interleave(means, scores).tolist() == [[1.0, 10.0, 2.0, 20.0], [3.0, 30.0, 4.0, 40.0]]
+
+def test_interleave_without_kinases():
+    empty = np.zeros((0, 3))
+    assert engine.interleave(empty, empty, empty).shape == (0, 9)
+
+# A dataset with no phosphosite in the K-S db gives empty kinase and link tables with the usual columns.
+def test_multi_sample_algorithms_without_matches():
+    df = pd.DataFrame({"Site": ["FOO_S1", "BAR_T2"], "a": [1.5, 2.0], "b": [3.0, 0.5]})
+    samples, sites, matrix = engine.parseSamples(df)
+    matched = engine.matchSites(sites, KS_DB)
+    assert matched[0] == []
+    for mod in [ztest_multi, ks_multi, karp_multi]:
+        scores, links = mod.scoreSites(KS_DB, samples, matrix, matched)
+        assert len(scores) == 0 and len(links) == 0
+        assert [stat + "b" for stat in mod.SAMPLE_STATS] == list(scores.columns[-len(mod.SAMPLE_STATS):])
+
+# Batched KS tests match scipy's two-sample test, including tied values and substrates linked more than once.
+# p-values are exact for these sample sizes, and asymptotic (method="asymp") for samples larger than KS_EXACT_MAX.
+def test_ks_tests_match_scipy(monkeypatch):
+    rng = np.random.default_rng(1)
+    values = np.round(rng.normal(size=(30, 3)), 1)
+    sub_weights = (rng.random((40, 30)) < 0.15).astype(int) * rng.integers(1, 3, size=(40, 30))
+    sub_weights[:, 0] = np.where(sub_weights.sum(axis=1) == 0, 1, sub_weights[:, 0])
+    nonsub_weights = (sub_weights == 0).astype(int)
+    for method in ["exact", "asymp"]:
+        if method == "asymp":
+            monkeypatch.setattr(engine, "KS_EXACT_MAX", 0)
+        ks_stats, pvals = engine.ksTests(values, sub_weights, nonsub_weights, chunk=7, workers=2)
+        for kin in range(sub_weights.shape[0]):
+            for col in range(values.shape[1]):
+                result = st.ks_2samp(np.repeat(values[:, col], sub_weights[kin]), values[nonsub_weights[kin] > 0, col], method=method)
+                assert np.isclose(ks_stats[kin, col], result.statistic, rtol=1e-12, atol=1e-12)
+                assert np.isclose(pvals[kin, col], result.pvalue, rtol=1e-9, atol=1e-12)
+
+# A kinase with a single substrate at the edge of the values has the largest possible statistic (1), and an exact p-value of 2 / (sites).
+# The asymptotic distribution gives 0 for it, which made its -log10(p-value) infinite.
+def test_ks_tests_single_substrate():
+    values = np.arange(400, dtype=float).reshape(-1, 1)
+    sub_weights = np.zeros((1, 400), dtype=int)
+    sub_weights[0, -1] = 1
+    ks_stats, pvals = engine.ksTests(values, sub_weights, (sub_weights == 0).astype(int))
+    assert ks_stats[0, 0] == 1
+    assert np.isclose(pvals[0, 0], st.ks_2samp(values[-1:, 0], values[:-1, 0]).pvalue)
+    assert np.isclose(pvals[0, 0], 2 / 400.0)
+
+# Empirical p-values converge to the exact permutation p-values, which are enumerated over every permutation of a tiny dataset.
+# Each permutation is a column of values, so the exact null statistics come from one batched call.
+def test_permutation_p_values_match_enumeration():
+    values = np.array([[0.5, -1.2], [1.5, 0.3], [1.5, 2.2], [-0.7, 0.3], [2.1, -0.4], [0.0, 1.1], [-1.8, 0.9]])
+    link_site = np.array([0, 1, 2, 3, 4, 1, 5, 5])
+    link_kin = np.array([0, 0, 1, 1, 1, 2, 2, 2])
+    n_kin = 3
+    permutations = 20000
+    orders = np.array(list(itertools.permutations(range(len(values))))).T
+    counts, sums, means = engine.kinaseStats(values, link_site, link_kin, n_kin)
+    z, pvals = engine.zScores(values, means, counts)
+    empirical = engine.zPermutations(values, link_site, link_kin, n_kin, z, permutations)
+    assert np.array_equal(empirical, engine.zPermutations(values, link_site, link_kin, n_kin, z, permutations))
+    for col in range(values.shape[1]):
+        null_sums = engine.kinaseStats(values[orders, col], link_site, link_kin, n_kin)[1]
+        upper = engine.empiricalCount(null_sums, sums[:, [col]]).mean(axis=1)
+        lower = engine.empiricalCount(-null_sums, -sums[:, [col]]).mean(axis=1)
+        assert np.allclose(empirical[:, col], np.where(z[:, col] < 0, lower, upper), atol=0.02)
+
+    universe, sub_weights = engine.substrateWeights(link_site, link_kin, n_kin)
+    nonsub_weights = (sub_weights == 0).astype(int)
+    ks_stats = engine.ksTests(values[universe], sub_weights, nonsub_weights)[0]
+    empirical = engine.ksPermutations(values[universe], sub_weights, ks_stats, permutations)
+    assert np.array_equal(empirical, engine.ksPermutations(values[universe], sub_weights, ks_stats, permutations))
+    orders = np.array(list(itertools.permutations(range(len(universe))))).T
+    for col in range(values.shape[1]):
+        null_stats = engine.ksTests(values[universe][orders, col], sub_weights, nonsub_weights)[0]
+        exact = engine.empiricalCount(null_stats, ks_stats[:, [col]]).mean(axis=1)
+        assert np.allclose(empirical[:, col], exact, atol=0.02)
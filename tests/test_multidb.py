@@ -0,0 +1,51 @@
+from io import StringIO
+
+import pandas as pd
+
+import multidb
+
+SITES = ["AKT1_S473", "GSK3B_S9", "MAPK1_T185", "RPS6_S235"]
+DATASET = pd.DataFrame({"Site": SITES, "a": [1.5, 2.0, 0.3, -0.7], "b": [3.0, 0.5, 1.0, 0.2]})
+
+def database(links):
+    sites = {}
+    totals = {}
+    for site, kinase in links:
+        sites.setdefault(site, []).append((kinase, "XXXXXXXSXXXXXXX", "PSP"))
+        totals[kinase] = totals.get(kinase, 0) + 1
+    return {"sites": sites, "totals": totals}
+
+def readTable(table):
+    return pd.read_json(StringIO(table), orient='split')
+
+# Per-sample statistics of a database in the comparison, without its substrate counts.
+def databaseStats(scores, db_key):
+    return scores[[col for col in scores.columns if col.endswith("." + db_key) and "Sub.Count" not in col]]
+
+# A database without matches, or one the algorithm cannot score, leaves its columns missing instead of failing the other databases.
+def test_unscored_databases_do_not_fail_the_job():
+    ks_dbs = {
+        "psp": database([("AKT1_S473", "PDPK1"), ("GSK3B_S9", "AKT1"), ("MAPK1_T185", "MAP2K1"), ("RPS6_S235", "AKT1")]),
+        "pdts": database([("OTHER_S1", "PDPK1")]),
+        # KS needs non-substrate sites, but PDPK1 is linked to every matched phosphosite.
+        "edges": database([("AKT1_S473", "PDPK1"), ("GSK3B_S9", "PDPK1")]),
+    }
+    for script in ["ztest_single", "ks_multi", "karp_multi"]:
+        scores, links, message, tables = multidb.userInput(ks_dbs, script, DATASET)
+        scores = readTable(scores)
+        assert list(scores["Kinase"]) == ["PDPK1", "AKT1", "MAP2K1"]
+        assert databaseStats(scores, "pdts").isna().all().all()
+        assert databaseStats(scores, "psp").notna().any().any()
+        if script == "ks_multi":
+            assert "edges" in message
+            assert databaseStats(scores, "edges").isna().all().all()
+            assert set(readTable(links)[multidb.DATABASE_COLUMN]) == {"psp"}
+        else:
+            assert "edges" not in message
+            assert set(readTable(links)[multidb.DATABASE_COLUMN]) == {"psp", "edges"}
+
+# Single-sample algorithms are run with their multi-sample implementation against all databases, and only then.
+def test_job_script():
+    assert multidb.jobScript("ztest_single", multidb.ALL_DATABASES) == "ztest_multi"
+    assert multidb.jobScript("ks_multi", multidb.ALL_DATABASES) == "ks_multi"
+    assert multidb.jobScript("ztest_single", "psp") == "ztest_single"
@@ -0,0 +1,21 @@
+import re
+
+import pandas as pd
+import pytest
+
+from tables import tablePage
+
+TABLE = pd.DataFrame({"Kinase": ["AKT1", "PDPK1", "MAPK1", "AKT2"], "Sub.Count": [3, 1, 2, 1]})
+
+def test_table_page_is_searched_sorted_and_sliced():
+    page = tablePage(TABLE, {"draw": "4", "start": "1", "length": "1", "search[value]": "akt", "order[0][column]": "1", "order[0][dir]": "desc"})
+    assert page == {"draw": 4, "recordsTotal": 4, "recordsFiltered": 2, "data": [["AKT2", 1]]}
+
+def test_table_page_defaults():
+    page = tablePage(TABLE, {})
+    assert page["draw"] == 0 and len(page["data"]) == 4
+
+@pytest.mark.parametrize("name", ["draw", "start", "length", "order[0][column]"])
+def test_table_page_rejects_non_integer_parameters(name):
+    with pytest.raises(ValueError, match=re.escape(name)):
+        tablePage(TABLE, {name: "x"})
@@ -1,16 +1,10 @@
-def userInput(ks_db, graphics, df, min_sub):
+def userInput(ks_db, graphics, df, min_sub, permutations=0):
     
-    import io
-    from io import StringIO
     import pandas as pd
     import scipy.stats as st
     import numpy as np
-    
-    if graphics == "yes":
-        import matplotlib as mpl
-        mpl.use('Agg')
-        import matplotlib.patches as mpatches
-        import matplotlib.pyplot as plt
+    import profiling
+    import engine
 
     # Function used to convert kinase z-scores to corresponding p-values.
     def getpValue(z):
@@ -27,9 +21,6 @@ def userInput(ks_db, graphics, df, min_sub):
         z = (mean_kin - mean_all) * sub_num**(1/2) / sd
         return z
     
-    # Convert JSON-string datatset back into a DF.
-    df = pd.read_json(df, orient="split")
-    
     # User data is passed from the server and parsed as appropriate.
     user_file=df.values.tolist()
     array=[]
@@ -80,19 +71,25 @@ def userInput(ks_db, graphics, df, min_sub):
     all_mean=sum(all_log2) / float(len(all_log2))
     all_std=np.std(all_log2)
 
-    # Each phosphosite in dic is scanned against the K-S db. 
+    # Phosphosites and their log2(FC) values are also arranged as a single-sample (sites x 1) matrix.
+    sites=list(dic)
+    matrix=np.array([dic[x] for x in sites]).reshape(-1, 1)
+
+    profiling.mark("parse")
+
+    # Each phosphosite in dic is looked up in the site-keyed index of the K-S db.
     # If a match is found, relevant information for that phosphosite is appended to a new array ks_links.
+    # link_site and link_kin map each link to its phosphosite and kinase.
+    kinases, links, link_site, link_kin = engine.matchSites(sites, ks_db)
     ks_links=[]
-    for x in dic:
-        for y in ks_db:
-            if x == y[0]:
-                ks_links.append([y[1], y[0], y[2], y[3], dic[x]])
-            else:
-                continue
+    for link in links:
+        ks_links.append(link + [dic[link[1]]])
 
     # The array is then converted into a dataframe.
     ks_links_df = pd.DataFrame(ks_links, columns=["Kinase", "Site", "Site.Seq(+/- 7AA)", "Source", "log2(FC)"])
 
+    profiling.mark("match")
+
     # A dictionary containing unique kinases and substrate log2(FCs) as values is created.
     # If the same kinase was identified for multiple substrates, multiple log2(FCs) are appended to the dictionary values.
     kinase_dic={}
@@ -116,103 +113,110 @@ def userInput(ks_db, graphics, df, min_sub):
         z_pval = getpValue(z_score)
         zscore_info.append([key, substrate_num, kin_fc_mean, z_score, z_pval])
 
+    # If permutations are requested, p-values are instead estimated from that many permutations of the phosphosite values.
+    # Kinases in kinase_dic are in the order of their first link, as in kinases.
+    if permutations > 0:
+        z_scores=np.array([info[3] for info in zscore_info]).reshape(-1, 1)
+        z_pvals=engine.zPermutations(matrix, link_site, link_kin, len(kinases), z_scores, permutations)
+        for info, z_pval in zip(zscore_info, z_pvals[:, 0]):
+            info[4] = z_pval
+
     # z-score array is converted into a pandas dataframe.
     zscore_df=pd.DataFrame(zscore_info, columns=["Kinase", "Sub.Count", "mnlog2(FC)", "zSc", "pVal"])
 
+    profiling.mark("statistics")
+
     # Barplot is only generated if the user chose to produce graphics at file upload.
+    # Otherwise it can be rendered later from the kinase scores with plotScores.
     if graphics == "no":
         svg_fig = "Barplot was not generated for this analysis."
     elif graphics == "yes":
-        # For easier plot manipulation, the array is sorted in an ascending order according to the z-score.
-        zscore_info.sort(key=lambda x: float(x[3]))
-
-        # Kinase label for y-axis.
-        kinases = []
-
-        # Corresponding z-scores.
-        score_list = []
-
-        # Extraction of desirable results that match user-defined parameters.
-        # min_sub denotes the minimum substrate count per kinase indicated by the user.
-        for entry in zscore_info:
-            kin=entry[0]
-            sub=entry[1]
-            score = entry[3]
-            if sub >= min_sub:
-                kinases.append(kin)
-                score_list.append(score)
-
-        # Dictionary of kinases as keys and p-values as values. 
-        # It will serve as a map for the colour coding of the barplot bars.
-        kin_map={}
-        for entry in zscore_info:
-            kin=entry[0]
-            pval=entry[4]
-            kin_map[kin]=pval
-
-        # A list of colours for the barplot. 
-        colours=[]
-        for kin in kinases:
-            # Bars are pale red if p-value is smaller than 0.05.
-            if kin_map[kin] < 0.05 and kin_map[kin] >= 0.01:
-                colours.append("#ffb3b3")
-            # Bars are bright red if p-value is less than 0.01.
-            elif kin_map[kin] < 0.01:
-                colours.append("#ff4d4d")
-            # Otherwise the bars remain grey.
-            else:
-                 colours.append("#b3b3b3")
-
-        # Generate an array of sequence to be used to plot the y-axis values.
-        y_pos = np.arange(len(kinases))
-        n=len(y_pos)
-
-        # Set the margins and bar height for a single category.
-        topmargin = 0.1 #inches
-        bottommargin = 0.1 #inches
-        categorysize = 0.15 # inches
-
-        # Calculate a dynamic figure height based on the known values above.
-        figheight = topmargin + bottommargin + (n+1)*categorysize
-
-        # Figure box and axes are plotted here.
-        fig, ax = plt.subplots(figsize=(5, figheight))
-
-        # Horizontal bars are generated.
-        ax.barh(y_pos, score_list, color=colours)
-
-        # Y-axis limit to reduce the top and bottom margin white spaces.
-        plt.ylim(min(y_pos)-1, max(y_pos)+1)
-
-        # Barplot is styled and labelled.
-        ax.set_yticks(y_pos)
-        ax.set_yticklabels(kinases)
-        for pos in ['right','top', 'left']:
-            ax.spines[pos].set_visible(False)
-        ax.tick_params(left=False)
-        plt.yticks(fontsize=6)
-        plt.xticks(fontsize=6)
-        plt.ylabel("Kinase", fontsize=6)
-        plt.xlabel("Z-score", fontsize=6)
-
-        # A legend to indicate the meaning of the bar colours.
-        non_sig = mpatches.Patch(color="#b3b3b3", label='p-value >= 0.05')
-        sig = mpatches.Patch(color="#ffb3b3", label='p-value >= 0.01')
-        extra_sig = mpatches.Patch(color="#ff4d4d", label='p-value < 0.01')
-        plt.legend(handles=[non_sig, sig, extra_sig], bbox_to_anchor=(-0.45, 1), loc=2, fontsize=6)
-
-        # Create a StringIO object and use it to write SVG figure data to string buffer.
-        fig_file = StringIO()
-        fig.savefig(fig_file, format='svg', bbox_inches="tight")
-        # Seek beginning of the figure file.
-        fig_file.seek(0)
-        # Retrieve figure contents as a string.
-        svg_fig = '<svg' + fig_file.getvalue().split('<svg')[1]
-        # Free memory buffer.
-        fig_file.close()
-        
+        svg_fig = plotScores(zscore_df, min_sub)
+
+    profiling.mark("plot")
+
     # Convert results DFs into JSON strings.
     zscore_df = zscore_df.to_json(orient='split')
     ks_links_df = ks_links_df.to_json(orient='split')
     
-    return zscore_df, ks_links_df, svg_fig
\ No newline at end of file
+    profiling.mark("serialize")
+
+    return zscore_df, ks_links_df, svg_fig
+
+# The barplot of kinase z-scores is rendered from the kinase scores dataframe.
+# Only kinases with at least min_sub substrates are shown. size scales the figure and fmt is "svg" or "png".
+def plotScores(zscore_df, min_sub, size=1.0, fmt="svg"):
+
+    import numpy as np
+    import matplotlib as mpl
+    mpl.use('Agg')
+    import matplotlib.patches as mpatches
+    import matplotlib.pyplot as plt
+    from figures import saveFigure
+
+    # For easier plot manipulation, kinases are sorted in an ascending order according to the z-score.
+    zscore_df = zscore_df.sort_values("zSc", kind="mergesort")
+
+    # Extraction of desirable results that match user-defined parameters.
+    # min_sub denotes the minimum substrate count per kinase indicated by the user.
+    plot_df = zscore_df[zscore_df["Sub.Count"] >= min_sub]
+
+    # Kinase label for y-axis.
+    kinases = plot_df["Kinase"].tolist()
+
+    # Corresponding z-scores.
+    score_list = plot_df["zSc"].tolist()
+
+    # A list of colours for the barplot, coded by kinase p-values.
+    colours=[]
+    for pval in plot_df["pVal"]:
+        # Bars are pale red if p-value is smaller than 0.05.
+        if pval < 0.05 and pval >= 0.01:
+            colours.append("#ffb3b3")
+        # Bars are bright red if p-value is less than 0.01.
+        elif pval < 0.01:
+            colours.append("#ff4d4d")
+        # Otherwise the bars remain grey.
+        else:
+             colours.append("#b3b3b3")
+
+    # Generate an array of sequence to be used to plot the y-axis values.
+    y_pos = np.arange(len(kinases))
+    n=len(y_pos)
+
+    # Set the margins and bar height for a single category.
+    topmargin = 0.1 #inches
+    bottommargin = 0.1 #inches
+    categorysize = 0.15 # inches
+
+    # Calculate a dynamic figure height based on the known values above.
+    figheight = topmargin + bottommargin + (n+1)*categorysize
+
+    # Figure box and axes are plotted here.
+    fig, ax = plt.subplots(figsize=(5*size, figheight*size))
+
+    # Horizontal bars are generated.
+    ax.barh(y_pos, score_list, color=colours)
+
+    # Y-axis limit to reduce the top and bottom margin white spaces.
+    plt.ylim(min(y_pos)-1, max(y_pos)+1)
+
+    # Barplot is styled and labelled.
+    ax.set_yticks(y_pos)
+    ax.set_yticklabels(kinases)
+    for pos in ['right','top', 'left']:
+        ax.spines[pos].set_visible(False)
+    ax.tick_params(left=False)
+    plt.yticks(fontsize=6)
+    plt.xticks(fontsize=6)
+    plt.ylabel("Kinase", fontsize=6)
+    plt.xlabel("Z-score", fontsize=6)
+
+    # A legend to indicate the meaning of the bar colours.
+    non_sig = mpatches.Patch(color="#b3b3b3", label='p-value >= 0.05')
+    sig = mpatches.Patch(color="#ffb3b3", label='p-value >= 0.01')
+    extra_sig = mpatches.Patch(color="#ff4d4d", label='p-value < 0.01')
+    plt.legend(handles=[non_sig, sig, extra_sig], bbox_to_anchor=(-0.45, 1), loc=2, fontsize=6)
+
+    # The figure is returned as SVG markup or PNG data.
+    return saveFigure(fig, fmt)